@@ -1,21 +1,39 @@
 import errno
+import hashlib
 import json
 import os.path
+import subprocess
 import sys
-from subprocess import call, Popen, PIPE
-from typing import Dict, TypeVar, Sequence
+import tempfile
+import time
+import zlib
+from typing import Callable, Collection, Dict, Iterator, List, Optional, \
+    Set, Tuple, TypeVar, Sequence
 
 import argparse
 import requests
+from github import Github, GithubException
 from github.Organization import Organization
+from github.Team import Team
 from requests.auth import AuthBase
 
 from config import Config
+from filesync import ExcludeFilter, build_manifest, load_manifest, \
+    rsync_command, save_manifest, sync_changes, sync_tree
+from gitbackend import get_backend
+from github_api import ApiScheduler, GitHubClient, branch_states, \
+    GitHubAPIError, create_pull_requests, ensure_template_repo, \
+    generate_from_template
+from utils import SYNC_STATE_DIR, CommandFailed, canonical_group_name, \
+    normalize, report_failures, run_logged, run_per_repo
 
 # Generics for type hints in merge_dicts()
 _KT = TypeVar("_KT")
 _VT = TypeVar("_VT")
 
+FEEDBACK_EXCLUDES = ["*/.git", "*/.gitignore", "*/*.class"]
+"Always excluded when copying TA folders back into the submission folder"
+
 
 # this makes a copy
 def merge_dicts(base_dict: Dict[_KT, _VT], update_with: Dict[_KT, _VT]) -> Dict[
@@ -54,188 +72,1026 @@ class Infrastructor(object):
     default_parser.add_argument('-v', '--verbose',
                                 action='store_true',
                                 help='enable verbose output')
+    default_parser.add_argument('-j', '--jobs', type=int, default=1,
+                                help='number of repositories to process '
+                                     'concurrently (default: 1)')
 
     @staticmethod
     def pull_all(config: Config, basepath: str, use_user_name: bool,
-                 anonymize: bool) -> None:
+                 anonymize: bool, jobs: int = 1,
+                 heads: Optional[Dict[str, str]] = None,
+                 partial: bool = False,
+                 dissociate: bool = False) -> Dict[str, Exception]:
         """Pulls all repositories into archive and submission dirs
 
+        Repositories are cloned/pulled by up to `jobs` workers at a time.
+        Output is collected per repository and a failure in one repository
+        does not stop the others; failures are summarized at the end.
+
+        If `heads` is given (see `remote_heads`), repositories whose remote
+        head matches the head recorded by the last successful pull into
+        basepath are skipped.
+
+        With the config's `share_starter_objects`, new clones borrow the
+        starter commits from a shared store (see `starter_store`) instead
+        of downloading them again.
+
         :param config: The Config object for the assignment
         :param basepath: Pate to base directory
         :param use_user_name: Whether to use username as part of path
         :param anonymize: Whether to anonymize reponame
+        :param jobs: Maximum number of repositories processed concurrently
+        :param heads: Optional map from repository to its remote head SHA
+        :param partial: Whether to honor the config's `clone_filter` and
+                        `sparse_paths`; archive clones should stay full
+        :param dissociate: Whether new clones copy the borrowed starter
+                           objects, so that they never depend on the store;
+                           archive clones should be self-contained
+        :return: A map from each failed repository to its error
         """
-        for repo in config.repositories:
-            rpath = config.pull_path(basepath, repo, use_user_name, anonymize)
-            if not os.path.exists(rpath):
-                # clone it
-                print(f"Cloning {config.repo_ssh_path(repo)} to {rpath}.")
-                call(["git", "clone", config.repo_ssh_path(repo), rpath])
-            else:  # existing repository
-                # make sure we're on the default branch
-                print(f"Switching to '{config.default_branch}' branch in "
-                      f"{config.repo_ssh_path(repo)} at {rpath}")
-                Popen(["git", "checkout", config.default_branch],
-                      cwd=rpath).wait()  # note: blocking
-
-                # first reset repository
-                print(f"Resetting {config.repo_ssh_path(repo)} at {rpath}")
-                Popen(["git", "checkout", "."],
-                      cwd=rpath).wait()  # note: blocking
-
-                # pull it
-                print(f"Pulling {config.repo_ssh_path(repo)} in {rpath}")
-                Popen(["git", "pull"], cwd=rpath).wait()  # note: blocking
-
-            # if a due date was specified, roll back to due date
-            if hasattr(config,
-                       "do_not_accept_changes_after_due_date_timestamp"):
-                proc = Popen(
-                    ["git",
-                     "rev-list",
-                     "-1",
-                     "--before=\"" + str(config.due_date) + "\"",
-                     config.default_branch],
-                    stdout=PIPE,
-                    stderr=PIPE,
-                    cwd=rpath
-                )
-                stdout, _ = proc.communicate()  # note: blocking
-                pathspec = stdout.rstrip()
-                Popen(["git",
-                       "checkout",
-                       pathspec],
-                      cwd=rpath).wait()  # note: blocking
+        rpaths = {repo: config.pull_path(basepath, repo, use_user_name,
+                                         anonymize)
+                  for repo in config.repositories}
+        reference = Infrastructor.starter_store(config, basepath) \
+            if config.share_starter_objects else None
+
+        def pull(repo: str, out: List[str]) -> None:
+            Infrastructor.pull_repo(config, repo, rpaths[repo], out, partial,
+                                    reference, dissociate)
+
+        return Infrastructor.run_synced(basepath, "pull", pull, rpaths, heads,
+                                        jobs)
+
+    @staticmethod
+    def pull_repo(config: Config, repo: str, rpath: str,
+                  out: List[str], partial: bool = False,
+                  reference: Optional[str] = None,
+                  dissociate: bool = False) -> None:
+        """Clones or pulls a single repository, then applies the due date
+        cutoff if one was specified
+
+        :param config: The Config object for the assignment
+        :param repo: Name of the repository
+        :param rpath: Local path of the repository
+        :param out: Output buffer for this repository
+        :param partial: Whether to clone with the config's `clone_filter`
+                        and check out only its `sparse_paths`
+        :param reference: Path of an object store to borrow objects from
+                          when cloning
+        :param dissociate: Whether to copy the borrowed objects after
+                           cloning
+        :raises CommandFailed: if any git command fails
+        """
+        sparse = partial and bool(config.sparse_paths)
+        if not os.path.exists(rpath):
+            # clone it
+            out.append(f"Cloning {config.repo_ssh_path(repo)} to {rpath}.\n")
+            cmd = ["git", "clone"]
+            if partial and config.clone_filter:
+                # blobs over the limit are fetched lazily, on checkout
+                cmd.append(f"--filter={config.clone_filter}")
+            if sparse:
+                cmd.append("--no-checkout")
+            if reference is not None:
+                cmd += ["--reference-if-able", reference]
+                if dissociate:
+                    cmd.append("--dissociate")
+            run_logged(cmd + [config.repo_ssh_path(repo), rpath], out)
+            if sparse:
+                Infrastructor.set_sparse_paths(config, rpath, out)
+                run_logged(["git", "checkout", config.default_branch], out,
+                           cwd=rpath)
+        else:  # existing repository
+            # make sure we're on the default branch
+            out.append(f"Switching to '{config.default_branch}' branch in "
+                       f"{config.repo_ssh_path(repo)} at {rpath}\n")
+            run_logged(["git", "checkout", config.default_branch], out,
+                       cwd=rpath)
+
+            # first reset repository
+            out.append(f"Resetting {config.repo_ssh_path(repo)} at {rpath}\n")
+            run_logged(["git", "checkout", "."], out, cwd=rpath)
+            if sparse:
+                # sparse_paths may have changed since the clone
+                Infrastructor.set_sparse_paths(config, rpath, out)
+
+            # pull it
+            out.append(f"Pulling {config.repo_ssh_path(repo)} in {rpath}\n")
+            run_logged(["git", "pull"], out, cwd=rpath)
+
+        Infrastructor.checkout_due_date(config, rpath, out)
+
+    @staticmethod
+    def starter_store(config: Config, basepath: str) -> Optional[str]:
+        """Creates or updates the object store of starter commits that
+        clones under basepath borrow from, `.infrastructor/starter.git`
+
+        Clones made without `--dissociate` need the store's objects for as
+        long as they exist, so the store never drops any: garbage collection
+        is disabled and fetches only add objects.
+
+        :param config: The Config object for the assignment
+        :param basepath: Base directory of the clones
+        :return: Path of the store, or None if it could not be updated
+        """
+        store = os.path.join(basepath, SYNC_STATE_DIR, "starter.git")
+        out: List[str] = []
+        try:
+            if not os.path.exists(store):
+                run_logged(["git", "init", "--quiet", "--bare", store], out)
+                run_logged(["git", "config", "gc.auto", "0"], out, cwd=store)
+                run_logged(["git", "config", "gc.pruneExpire", "never"], out,
+                           cwd=store)
+            run_logged(["git", "fetch", "--quiet", config.starter_repo,
+                        "+refs/heads/*:refs/heads/*"], out, cwd=store)
+        except CommandFailed as e:
+            print("".join(out), end="")
+            print(f"WARNING: could not update {store} ({e}); cloning "
+                  f"without it.", file=sys.stderr)
+            return None
+        return store
+
+    @staticmethod
+    def set_sparse_paths(config: Config, rpath: str, out: List[str]) -> None:
+        """Restricts the working tree of a repository to the config's
+        `sparse_paths`
+
+        :param config: The Config object for the assignment
+        :param rpath: Local path of the repository
+        :param out: Output buffer for this repository
+        :raises CommandFailed: if git fails
+        """
+        run_logged(["git", "sparse-checkout", "set", "--cone"] +
+                   config.sparse_paths, out, cwd=rpath)
+
+    @staticmethod
+    def pull_all_from_archive(config: Config, archive_basepath: str,
+                              basepath: str, use_user_name: bool,
+                              anonymize: bool, jobs: int = 1,
+                              heads: Optional[Dict[str, str]] = None,
+                              partial: bool = False
+                              ) -> Dict[str, Exception]:
+        """Updates all repositories in basepath from the local archive clones
+
+        Instead of contacting GitHub a second time, each repository is cloned
+        (with hardlinked objects) or fetched from its already-updated clone in
+        the archive.  The `origin` remote is then pointed back at GitHub so
+        that feedback branches can still be pushed upstream.  `heads` works
+        as in `pull_all`.
+
+        :param config: The Config object for the assignment
+        :param archive_basepath: Base path of the archive clones, which are
+                                 laid out by user name and not anonymized
+        :param basepath: Pate to base directory
+        :param use_user_name: Whether to use username as part of path
+        :param anonymize: Whether to anonymize reponame
+        :param jobs: Maximum number of repositories processed concurrently
+        :param heads: Optional map from repository to its remote head SHA
+        :param partial: Whether to check out only the config's
+                        `sparse_paths`
+        :return: A map from each failed repository to its error
+        """
+        rpaths = {repo: config.pull_path(basepath, repo, use_user_name,
+                                         anonymize)
+                  for repo in config.repositories}
+
+        def pull(repo: str, out: List[str]) -> None:
+            source = config.pull_path(archive_basepath, repo, True, False)
+            Infrastructor.pull_repo_from_local(config, repo, source,
+                                               rpaths[repo], out, partial)
+
+        return Infrastructor.run_synced(basepath, "pull", pull, rpaths, heads,
+                                        jobs)
+
+    @staticmethod
+    def pull_repo_from_local(config: Config, repo: str, source: str,
+                             rpath: str, out: List[str],
+                             partial: bool = False) -> None:
+        """Clones or updates a single repository from a local clone of the
+        same repository, then applies the due date cutoff
+
+        Objects are hardlinked from the local clone, so `clone_filter` would
+        save nothing; only `sparse_paths` applies.
+
+        :param config: The Config object for the assignment
+        :param repo: Name of the repository
+        :param source: Local path of an up-to-date clone of the repository
+        :param rpath: Local path of the repository
+        :param out: Output buffer for this repository
+        :param partial: Whether to check out only the config's
+                        `sparse_paths`
+        :raises CommandFailed: if any git command fails
+        """
+        sparse = partial and bool(config.sparse_paths)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"missing local clone {source}")
+
+        # the source's remote-tracking branches mirror GitHub as of its
+        # last pull; copy them so this clone sees the same remote state
+        mirror_origin = ["git", "fetch", "--quiet", source,
+                         "+refs/remotes/origin/*:refs/remotes/origin/*"]
+
+        if not os.path.exists(rpath):
+            out.append(f"Cloning {source} to {rpath}.\n")
+            run_logged(["git", "clone", "--quiet", "--branch",
+                        config.default_branch] +
+                       (["--no-checkout"] if sparse else []) +
+                       [source, rpath], out)
+            if sparse:
+                Infrastructor.set_sparse_paths(config, rpath, out)
+                run_logged(["git", "checkout", "--quiet",
+                            config.default_branch], out, cwd=rpath)
+            run_logged(["git", "remote", "set-url", "origin",
+                        config.repo_ssh_path(repo)], out, cwd=rpath)
+            run_logged(mirror_origin, out, cwd=rpath)
+            run_logged(["git", "branch", "--quiet",
+                        f"--set-upstream-to=origin/{config.default_branch}"],
+                       out, cwd=rpath)
+        else:  # existing repository
+            out.append(f"Switching to '{config.default_branch}' branch in "
+                       f"{rpath}\n")
+            run_logged(["git", "checkout", config.default_branch], out,
+                       cwd=rpath)
+
+            out.append(f"Resetting {rpath}\n")
+            run_logged(["git", "checkout", "."], out, cwd=rpath)
+            if sparse:
+                Infrastructor.set_sparse_paths(config, rpath, out)
+
+            out.append(f"Updating {rpath} from {source}\n")
+            run_logged(mirror_origin, out, cwd=rpath)
+            run_logged(["git", "merge", "--ff-only",
+                        f"origin/{config.default_branch}"], out, cwd=rpath)
+
+        Infrastructor.checkout_due_date(config, rpath, out)
+
+    @staticmethod
+    def checkout_due_date(config: Config, rpath: str, out: List[str]) -> None:
+        """Rolls a local repository back to the last commit before the due
+        date, if a due date was specified
+
+        :param config: The Config object for the assignment
+        :param rpath: Local path of the repository
+        :param out: Output buffer for this repository
+        """
+        if hasattr(config,
+                   "do_not_accept_changes_after_due_date_timestamp"):
+            git = get_backend(config.git_backend)
+            pathspec = git.rev_before(rpath, config.default_branch,
+                                      config.due_date)
+            git.checkout(rpath, pathspec, out)
+
+    @staticmethod
+    def remote_heads(config: Config, jobs: int = 1) -> Dict[str, str]:
+        """Looks up the default branch head of every remote repository
+
+        Uses one `git ls-remote` per repository, up to `jobs` at a time.
+        Repositories that cannot be reached or have no default branch are
+        left out of the result.
+
+        :param config: The Config object for the assignment
+        :param jobs: Maximum number of repositories queried concurrently
+        :return: A map from repository to the SHA of its default branch
+        """
+
+        def ls_remote(repo: str, out: List[str]) -> str:
+            proc = subprocess.run(
+                ["git", "ls-remote", config.repo_ssh_path(repo),
+                 "refs/heads/" + config.default_branch],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
+            )
+            if proc.returncode != 0:
+                raise CommandFailed(proc.args, proc.returncode)
+            return proc.stdout.split("\t", 1)[0].strip()
+
+        results, failures = run_per_repo(ls_remote, config.repositories, jobs)
+        report_failures(failures, "ls-remote")
+        return {repo: sha for repo, sha in results.items() if sha}
+
+    @staticmethod
+    def run_synced(basepath: str, section: str,
+                   fn: Callable[[str, List[str]], None],
+                   targets: Dict[str, str], heads: Optional[Dict[str, str]],
+                   jobs: int) -> Dict[str, Exception]:
+        """Runs a per-repository sync step, skipping repositories that have
+        not changed since that step last succeeded
+
+        The head each target was last synced at is recorded in a state file
+        named after `section` under `basepath`.  Without `heads`, every
+        repository is processed and no state is recorded.
+
+        :param basepath: Base directory holding the state file
+        :param section: Name of the sync step, e.g., "pull"
+        :param fn: The per-repository step, as for `run_per_repo`
+        :param targets: Map from repository to the path the step writes
+        :param heads: Optional map from repository to its remote head SHA
+        :param jobs: Maximum number of repositories processed concurrently
+        :return: A map from each failed repository to its error
+        """
+        state_file = os.path.join(basepath, SYNC_STATE_DIR, section + ".json")
+        state: Dict[str, str] = {}
+        repos = list(targets.keys())
+        if heads is not None:
+            if os.path.exists(state_file):
+                with open(state_file, 'r') as f:
+                    state = json.load(f)
+            repos = [repo for repo in repos
+                     if repo not in heads
+                     or state.get(targets[repo]) != heads[repo]
+                     or not os.path.exists(targets[repo])]
+            print(f"{len(targets) - len(repos)} of {len(targets)} "
+                  f"repositories unchanged; skipping {section}.")
+
+        done, failures = run_per_repo(fn, repos, jobs)
+        report_failures(failures, section)
+
+        if heads is not None:
+            for repo in done:
+                if repo in heads:
+                    state[targets[repo]] = heads[repo]
+            os.makedirs(os.path.dirname(state_file), exist_ok=True)
+            tmp = state_file + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.replace(tmp, state_file)
+        return failures
 
     @staticmethod
-    def push_starter(config: Config) -> None:
+    def push_starter(config: Config, jobs: int = 1,
+                     repos: Optional[Sequence[str]] = None
+                     ) -> Dict[str, Exception]:
         """Pushes the starter repo to all student repositories.
 
-        Starter code is distributed by setting each student repository as a
-        "remote" for the starter repository and then `push`ing.  Student
-        repositories _must_ be empty (i.e., no `main` branch) otherwise
-        `push` will fail.
+        The default branch of the starter repository is pushed straight to
+        each student repository's URL, up to `jobs` at a time; no remotes
+        are added to the starter repository.  Repositories whose default
+        branch is already at the starter's tip are skipped.  Student
+        repositories must be empty or behind the starter, otherwise `push`
+        will fail.
 
         :param config: The Config object for the assignment
+        :param jobs: Maximum number of repositories pushed concurrently
+        :param repos: The repositories to push to, by default the
+                      assignment's repositories
+        :return: The repositories that could not be pushed to, with errors
         """
         print(f"starter repo is: {config.starter_repo}")
+        branch = "refs/heads/" + config.default_branch
+        tip = subprocess.run(["git", "rev-parse", "--verify", branch],
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             cwd=config.starter_repo,
+                             check=True).stdout.strip()
+
+        def push(repo: str, out: List[str]) -> bool:
+            url = config.repo_ssh_path(repo)
+            proc = subprocess.run(["git", "ls-remote", url, branch],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+            if proc.returncode != 0:
+                out.append(proc.stderr)
+                raise CommandFailed(proc.args, proc.returncode)
+            if proc.stdout.split("\t", 1)[0].strip() == tip:
+                out.append(f"{repo}: already at {tip[:7]}\n")
+                return False
+            run_logged(["git", "push", url, f"{branch}:{branch}"], out,
+                       cwd=config.starter_repo)
+            return True
+
+        results, failures = run_per_repo(
+            push, config.repositories if repos is None else repos, jobs)
+        pushed = len([r for r in results.values() if r])
+        print(f"Pushed starter {tip[:7]} to {pushed} repositories; "
+              f"{len(results) - pushed} already up to date, "
+              f"{len(failures)} failed.")
+        report_failures(failures, "push")
+        return failures
+
+    @staticmethod
+    def build_template(config: Config, client: GitHubClient, owner: str,
+                       name: str) -> None:
+        """Creates (or updates) a template repository from the starter repo
+
+        Student repositories generated from the template are copied by
+        GitHub, so the starter code is uploaded from this host only once.
+
+        :param config: The Config object for the assignment
+        :param client: The API client
+        :param owner: The organization that owns the template
+        :param name: The name of the template repository
+        :raises GitHubAPIError: if the template could not be set up
+        :raises CommandFailed: if the starter could not be pushed
+        """
+        if ensure_template_repo(client, owner, name,
+                                f"{config.course} starter template for "
+                                f"{config.assignment_name}."):
+            print(f"created template repository {owner}/{name}")
+        failures = Infrastructor.push_starter(config, repos=[name])
+        if failures:
+            raise failures[name]
+
+    @staticmethod
+    def propagate_starter(config: Config, revisions: str, branch: str,
+                          client: GitHubClient, jobs: int = 1,
+                          title: Optional[str] = None
+                          ) -> Dict[str, Exception]:
+        """Applies a range of starter repo commits to student repositories
+        that already have work in them, and opens a pull request in each
+
+        A preflight query fetches the branch state of every repository in a
+        few requests.  Each remaining repository is then cloned into a
+        temporary directory, `jobs` at a time.  Repositories that already
+        contain the change (the combined diff reverse-applies cleanly) are
+        skipped; otherwise the commits are applied with `git am --3way` on
+        a new `branch`, which is pushed.  The pull requests are created in
+        batched mutations.
+
+        :param config: The Config object for the assignment
+        :param revisions: The starter commits, e.g., "abc123..main" or
+                          "abc123^!"
+        :param branch: The branch the commits are pushed to
+        :param client: A GitHub API client
+        :param jobs: Maximum number of repositories processed concurrently
+        :param title: Title of the pull requests; by default the subject of
+                      the last commit
+        :return: The repositories that could not be updated, with errors
+        """
+        def git(*args: str) -> bytes:
+            # patches are kept as bytes, so CRLF line endings and files in
+            # any encoding survive
+            return subprocess.run(["git"] + list(args),
+                                  stdout=subprocess.PIPE,
+                                  cwd=config.starter_repo,
+                                  check=True).stdout
+
+        subjects = git("log", "--reverse", "--format=%s", revisions
+                       ).decode('utf-8', errors='replace').splitlines()
+        if not subjects:
+            print(f"No starter commits in {revisions}.")
+            return {}
+        patches = git("format-patch", "--stdout", revisions)
+        combined = git("diff", "--binary", revisions)
+
+        states = branch_states(client, config.github_org,
+                               config.repositories, config.default_branch,
+                               branch)
+        failures: Dict[str, Exception] = {}
+        eligible = []
         for repo in config.repositories:
-            actual_repo = config.repo_ssh_path(repo)
-            Popen(["git", "remote", "add", repo, actual_repo],
-                  cwd=config.starter_repo).wait()
-            Popen(["git", "push", repo, config.default_branch],
-                  cwd=config.starter_repo).wait()
+            state = states.get(repo)
+            if state is None:
+                failures[repo] = GitHubAPIError(
+                    f"{repo} does not exist in {config.github_org}")
+            elif not state.has_default:
+                failures[repo] = GitHubAPIError(
+                    f"{config.default_branch} branch does not exist in "
+                    f"{repo}")
+            elif state.has_feedback:
+                print(f"{repo}: {branch} branch already exists; skipping.")
+            else:
+                eligible.append(repo)
+
+        def apply(repo: str, out: List[str]) -> bool:
+            with tempfile.TemporaryDirectory(prefix=repo + "-") as tmp:
+                rdir = os.path.join(tmp, repo)
+                run_logged(["git", "clone", "--quiet", "--branch",
+                            config.default_branch,
+                            config.repo_ssh_path(repo), rdir], out)
+                with open(os.path.join(tmp, "combined.diff"), "wb") as f:
+                    f.write(combined)
+                with open(os.path.join(tmp, "series.mbox"), "wb") as f:
+                    f.write(patches)
+                if run_logged(["git", "apply", "--reverse", "--check",
+                               os.path.join(tmp, "combined.diff")], [],
+                              cwd=rdir, check=False).returncode == 0:
+                    out.append(f"{repo}: already has {revisions}\n")
+                    return False
+                run_logged(["git", "checkout", "--quiet", "-b", branch], out,
+                           cwd=rdir)
+                run_logged(["git", "am", "--quiet", "--3way", "--keep-cr",
+                            os.path.join(tmp, "series.mbox")], out, cwd=rdir)
+                run_logged(["git", "push", "--quiet", "origin", branch], out,
+                           cwd=rdir)
+            return True
+
+        results, apply_failures = run_per_repo(apply, eligible, jobs)
+        failures.update(apply_failures)
+        pushed = [repo for repo, applied in results.items() if applied]
+
+        body = "Starter code update for " + config.assignment_name + \
+               " from " + config.course + " teaching staff:\n\n" + \
+               "".join(f"- {subject}\n" for subject in subjects)
+        created = create_pull_requests(client, {
+            repo: {"repositoryId": states[repo].repo_id,
+                   "baseRefName": config.default_branch,
+                   "headRefName": branch,
+                   "title": title or subjects[-1],
+                   "body": body}
+            for repo in pushed})
+        for repo, result in created.items():
+            if result.startswith("ERROR:"):
+                failures[repo] = GitHubAPIError(result[len("ERROR: "):])
+            else:
+                print(f"{repo}: {result}")
+
+        report_failures(failures, "propagate")
+        opened = [repo for repo in pushed if repo not in failures]
+        print(f"Propagated {len(subjects)} starter commit(s) to "
+              f"{len(opened)} repositories; "
+              f"{len(results) - len(pushed)} already had them, "
+              f"{len(failures)} failed.")
+        return failures
+
+    @staticmethod
+    def repo_description(config: Config, group: Sequence[str]) -> str:
+        """Returns the GitHub description of a student repository
+
+        :param config: The Config object for the assignment
+        :param group: The students the repository belongs to
+        :return: The description
+        """
+        return (" and ".join(group) + "'s " + config.course +
+                " repository for " + config.assignment_name + ".")
+
+    @staticmethod
+    def team_name(config: Config, students: Sequence[str]) -> str:
+        """Returns the name of the GitHub team for a group of students
+
+        The name depends only on the course and the (sorted) members, so the
+        same group gets the same team in every assignment of a course.
+
+        :param config: The Config object for the assignment
+        :param students: The members of the team
+        :return: The team name
+        """
+        return normalize(config.course) + "-" + canonical_group_name(students)
+
+    @staticmethod
+    def repo_teams(config: Config, repo: str, teams: str
+                   ) -> Dict[str, List[str]]:
+        """Returns the teams that should have access to a repository
+
+        :param config: The Config object for the assignment
+        :param repo: The name of the repository
+        :param teams: "group" for one team per group, or "student" for one
+                      team per student
+        :return: The members of each team, by team name
+        """
+        group = config.lookupGroup(repo)
+        if teams == "group":
+            return {Infrastructor.team_name(config, group): list(group)}
+        return {Infrastructor.team_name(config, [s]): [s] for s in group}
+
+    @staticmethod
+    def provision_repositories(config: Config, g: Github, org: Organization,
+                               scheduler: ApiScheduler,
+                               teams: Optional[str] = None,
+                               template: Optional[str] = None,
+                               client: Optional[GitHubClient] = None
+                               ) -> Dict[str, int]:
+        """Creates missing student repositories and grants missing access,
+        concurrently
+
+        The organization's repositories, and the collaborators and pending
+        invitations (or teams) of the assignment's existing repositories,
+        are listed first.  Only the difference between that and the config
+        is applied, so re-running on a fully provisioned class makes only
+        listing calls.
+
+        With `teams`, students are not invited to each repository.  Instead
+        every group (or student) has a team that is kept across the
+        assignments of a course, and each repository is granted to its
+        team(s) with push access.  Members are only added to a team when it
+        is created or granted a new repository.
+
+        With `template`, missing repositories are generated from that
+        template repository (see `build_template`), so they already contain
+        the starter code and `push_starter` is not needed.
+
+        :param config: The Config object for the assignment
+        :param g: A github.Github object
+        :param org: A github.Organization object
+        :param scheduler: Throttles, retries and parallelizes API calls
+        :param teams: None for per-student invitations, "group" or
+                      "student" for team-based access
+        :param template: The "owner/name" of a template repository to
+                         create missing repositories from
+        :param client: The API client used with `template`
+        :return: Counts of what was done, keyed by "created", "invited",
+                 "granted", "unchanged" and "failed"
+        """
+        wanted = config.repositories
+        existing = scheduler.call(
+            lambda: {r.name: r for r in org.get_repos(type="all")})
+        print(f"{len(existing)} repositories in {org.login}; "
+              f"{len([r for r in wanted if r in existing])} of {len(wanted)} "
+              f"assignment repositories already exist.")
+
+        org_teams: Dict[str, Team] = {}
+        if teams is not None:
+            org_teams = scheduler.call(
+                lambda: {t.name.lower(): t for t in org.get_teams()})
+
+        def access(repo_name: str) -> Set[str]:
+            # GitHub logins and team names are case-insensitive
+            grepo = existing[repo_name]
+            if teams is not None:
+                return scheduler.call(
+                    lambda: {t.name.lower() for t in grepo.get_teams()})
+            logins = scheduler.call(lambda: {
+                u.login.lower()
+                for u in grepo.get_collaborators(affiliation="direct")})
+            logins |= scheduler.call(lambda: {
+                i.invitee.login.lower()
+                for i in grepo.get_pending_invitations()})
+            return logins
+
+        current, failures = scheduler.map(
+            access, [r for r in wanted if r in existing])
+
+        # compute what is missing
+        creates = [r for r in wanted if r not in existing]
+        invites: List[Tuple[str, str]] = []
+        grants: List[Tuple[str, str]] = []
+        members: Dict[str, List[str]] = {}
+        for repo_name in wanted:
+            if repo_name in failures:
+                continue
+            have = current.get(repo_name, set())
+            if teams is None:
+                invites.extend((repo_name, student)
+                               for student in config.lookupGroup(repo_name)
+                               if student.lower() not in have)
+                continue
+            for team, students in Infrastructor.repo_teams(
+                    config, repo_name, teams).items():
+                if team.lower() not in have:
+                    grants.append((repo_name, team))
+                    members[team] = students
+
+        def create(repo_name: str) -> None:
+            print(f"creating repository {repo_name}")
+            description = Infrastructor.repo_description(
+                config, config.lookupGroup(repo_name))
+            if template is not None:
+                assert client is not None
+                generate_from_template(client, template, org.login, repo_name,
+                                       description)
+                existing[repo_name] = g.get_repo(f"{org.login}/{repo_name}",
+                                                 lazy=True)
+                return
+            # auto_init=False so no README.md, license.txt, .gitignore ---
+            # use push-starter.py after running this script
+            existing[repo_name] = scheduler.call(lambda: org.create_repo(
+                repo_name,
+                description=description,
+                private=True,
+                auto_init=False
+            ))
+
+        created, create_failures = scheduler.map(create, creates)
+        failures.update(create_failures)
+
+        def create_team(team: str) -> None:
+            print(f"creating team {team}")
+            org_teams[team.lower()] = scheduler.call(lambda: org.create_team(
+                team,
+                privacy="secret",
+                description=" and ".join(members[team]) + "'s " +
+                            config.course + " team."
+            ))
+
+        def add_members(team: str) -> List[str]:
+            gteam = org_teams[team.lower()]
+            if team in new_teams:
+                have: Set[str] = set()
+            else:
+                have = scheduler.call(lambda: {
+                    u.login.lower() for u in gteam.get_members()})
+                have |= scheduler.call(lambda: {
+                    u.login.lower() for u in gteam.invitations()})
+            added = []
+            for student in members[team]:
+                if student.lower() in have:
+                    continue
+                print(f"adding {student} to team {team}.")
+                suser = scheduler.call(lambda: g.get_user(student))
+                scheduler.call(lambda: gteam.add_membership(suser, "member"))
+                added.append(student)
+            return added
+
+        def grant(team_grant: Tuple[str, str]) -> None:
+            repo_name, team = team_grant
+            print(f"granting team {team} push access to {repo_name} "
+                  f"repository.")
+
+            def put() -> None:
+                # PyGithub reports a refused grant (usually a 404 for a
+                # recently-created repository) as False rather than raising
+                if not org_teams[team.lower()].update_team_repository(
+                        existing[repo_name], "push"):
+                    raise GithubException(
+                        404, {"message": f"could not grant {team} access "
+                                         f"to {repo_name}"}, None)
+
+            scheduler.call(put, retry_statuses=(404,))
+
+        def invite(invitation: Tuple[str, str]) -> None:
+            repo_name, student = invitation
+            print(f"adding {student} as collaborator to {repo_name} "
+                  f"repository.")
+            # Github sometimes returns a 404 for recently-created repositories
+            scheduler.call(
+                lambda: existing[repo_name].add_to_collaborators(student),
+                retry_statuses=(404,))
+
+        new_teams = sorted(t for t in members if t.lower() not in org_teams)
+        _, team_failures = scheduler.map(create_team, new_teams)
+        for team, e in team_failures.items():
+            failures[f"team {team}"] = e
+        added, member_failures = scheduler.map(
+            add_members, sorted(t for t in members if t not in team_failures))
+        for team, e in member_failures.items():
+            failures[f"team {team}"] = e
+        granted, grant_failures = scheduler.map(
+            grant, [(r, t) for r, t in grants
+                    if r not in failures and t not in team_failures
+                    and t not in member_failures])
+        for (repo_name, team), e in grant_failures.items():
+            failures[f"{repo_name} ({team})"] = e
+
+        invited, invite_failures = scheduler.map(
+            invite, [i for i in invites if i[0] not in failures])
+        for (repo_name, student), e in invite_failures.items():
+            failures[f"{repo_name} ({student})"] = e
+
+        report_failures(failures, "provisioning")
+        touched = (set(created) | {repo_name for repo_name, _ in invited} |
+                   {repo_name for repo_name, _ in granted})
+        summary = {"created": len(created),
+                   "invited": (len(invited) +
+                               sum(len(a) for a in added.values())),
+                   "granted": len(granted),
+                   "unchanged": len([r for r in wanted
+                                     if r not in touched
+                                     and r not in failures]),
+                   "failed": len(failures)}
+        print(f"Provisioned {len(wanted)} repositories: "
+              f"{summary['created']} created, {summary['invited']} "
+              f"invitations sent, "
+              + (f"{summary['granted']} team grants, " if teams else "")
+              + f"{summary['unchanged']} already up to date, "
+              f"{summary['failed']} failed.")
+        return summary
 
     @staticmethod
     def initialize_attempt_counter(configs: Sequence[Config], server_url: str,
-                                   auth: AuthBase) -> None:
+                                   auth: AuthBase, compress: bool = False,
+                                   batch_size: int = 20, retries: int = 5,
+                                   state_file: Optional[str] = None) -> bool:
         """Passes a list of Infrastructor configs to attempt server
 
         so the server can parse the list configs and fill the database with
         corresponding lab assignments & students
 
+        Configs are sent in batches, each streamed as one JSON array over a
+        pooled session.  A batch that
+        fails with a connection error or a server error is retried with
+        exponential backoff.
+
         :param configs: a list Config objects
         :param server_url: the full URI for attemp server initialization API
         :param auth: Python request Authentication information
+        :param compress: Whether to gzip the request bodies; only for
+                         servers that decode gzip-encoded requests
+        :param batch_size: Number of configs sent per request
+        :param retries: Number of times a failed batch is retried
+        :param state_file: If given, only configs whose content changed since
+                           they were last sent successfully are sent, and the
+                           file is updated after every successful batch
+        :return: True if every batch was accepted
         """
         # Note that the Content-type header must be specified,
         # otherwise the server will reply with a 500 error
         headers = {'Content-type': 'application/json; charset=utf-8'}
-        config_list = [json.dumps(c.jsondict) for c in configs]
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
 
-        r = requests.post(
-            server_url,
-            data="[" + ",".join(config_list) + "]",
-            headers=headers,
-            auth=auth
-        )
+        def name(c: Config) -> str:
+            return f"{c.course}/{c.assignment_name}"
 
-        if r.status_code == 200:
-            print(r.json())
-        else:
-            print(r.status_code)
-            print(r.headers)
-            print(r.text)
+        def digest(c: Config) -> str:
+            return hashlib.sha1(json.dumps(c.jsondict, sort_keys=True)
+                                .encode('utf-8')).hexdigest()
+
+        def body(batch: Sequence[Config]) -> Iterator[bytes]:
+            gz = zlib.compressobj(wbits=31) if compress else None
+            for i, c in enumerate(batch):
+                chunk = ("[" if i == 0 else ",") + json.dumps(c.jsondict)
+                data = chunk.encode('utf-8')
+                if gz is not None:
+                    data = gz.compress(data)
+                # an empty chunk would end a chunked request body
+                if data:
+                    yield data
+            data = b"]"
+            yield gz.compress(data) + gz.flush() if gz is not None else data
+
+        sent: Dict[str, str] = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                sent = json.load(f)
+        hashes = {c: digest(c) for c in configs}
+        pending = [c for c in configs
+                   if sent.get(name(c)) != hashes[c]]
+        if state_file is not None:
+            print(f"{len(configs) - len(pending)} of {len(configs)} configs "
+                  f"unchanged since the last upload.")
+
+        session = requests.Session()
+        session.auth = auth
+        ok = True
+        for i in range(0, len(pending), max(1, batch_size)):
+            batch = pending[i:i + max(1, batch_size)]
+            r = None
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    time.sleep(min(60, 2 ** (attempt - 1)))
+                try:
+                    # a generator cannot be replayed; stream a fresh one
+                    r = session.post(server_url, data=body(batch),
+                                     headers=headers)
+                except requests.ConnectionError as e:
+                    print(f"attempt {attempt + 1}: {e}", file=sys.stderr)
+                    r = None
+                    continue
+                if r.status_code < 500 and r.status_code != 429:
+                    break
+
+            if r is not None and r.status_code == 200:
+                print(r.json())
+                if state_file is not None:
+                    sent.update({name(c): hashes[c] for c in batch})
+                    os.makedirs(os.path.dirname(state_file) or ".",
+                                exist_ok=True)
+                    with open(state_file, 'w') as f:
+                        json.dump(sent, f, indent=1, sort_keys=True)
+            else:
+                ok = False
+                names = ", ".join(name(c) for c in batch)
+                print(f"ERROR: could not upload {names}", file=sys.stderr)
+                if r is not None:
+                    print(r.status_code)
+                    print(r.headers)
+                    print(r.text)
+        return ok
 
     @staticmethod
     def copy_to_ta_folders(config: Config, ta_home: str, ta_dirname: str,
-                           basepath: str) -> None:
+                           basepath: str,
+                           heads: Optional[Dict[str, str]] = None,
+                           jobs: int = 1) -> None:
         """ Copies all local repositories to TA directories for grading
 
+        If `heads` is given (see `remote_heads`), repositories that were
+        already copied at that head are skipped.
+
         :param config: The Config object for the assignment
         :param ta_home: Path to home directory for all TA grading
         :param ta_dirname: Name of directory for this assignment
         :param basepath: Base path where local repositories are stored
+        :param heads: Optional map from repository to its remote head SHA
+        :param jobs: Maximum number of repositories copied concurrently
         """
         # keep track of repository -> TA map and print out the key
         # after doing all of the copying
-        ta_map = []
+        ta_map = {repo: config.TA_target(ta_home, ta_dirname, repo)
+                  for repo in config.repositories}
 
         # cp all files except git stuff and other junk
-        for repo in config.repositories:
-            # compute target
-            target = config.TA_target(ta_home, ta_dirname, repo)
+        excludes = ExcludeFilter(config.rsync_excludes)
 
-            # save mapping
-            ta_map.append((repo, target))
+        def copy(repo: str, out: List[str]) -> None:
+            # compute target
+            target = ta_map[repo]
 
             if not os.path.exists(target):
                 os.makedirs(target)
-            # compute source; add slash so that rsync copies
-            # _contents_ of folder into target
+            # compute source
             source = config.pull_path(
-                basepath, repo, False, config.anonymize_sub_path) + "/"
+                basepath, repo, False, config.anonymize_sub_path)
 
             # copy to ta folder
             if config.verbose:
-                print(f"Copying from {source} to {target}")
-            cmd = ["rsync",
-                   "-vurlptoD" if config.verbose else "-urlptoD"]
-            cmd.extend([f"--exclude={e}" for e in config.rsync_excludes])
-            cmd.extend([source, target])
-            call(cmd)
+                out.append(f"Copying from {source} to {target}\n")
+            Infrastructor.sync_folder(config, source, target, excludes, out)
+
+            # remember what was handed out so that copy_from_ta_folders can
+            # tell which files the TA touched
+            mpath = Infrastructor.manifest_path(basepath, ta_dirname, target)
+            save_manifest(mpath, build_manifest(source, excludes,
+                                                load_manifest(mpath)))
+
+        # the state lives with the (faculty-only) sources, not the TA copies
+        Infrastructor.run_synced(basepath, "copy-" + ta_dirname, copy,
+                                 ta_map, heads, jobs)
         # print mappings
-        for (repo, target) in ta_map:
+        for (repo, target) in ta_map.items():
             print(repo + " -> " + target)
 
     @staticmethod
     def copy_from_ta_folders(config: Config, ta_home: str,
-                             ta_dirname: str, basepath: str) -> None:
+                             ta_dirname: str, basepath: str,
+                             jobs: int = 1) -> Set[str]:
         """ Copies all local repositories back from TA directories after grading
 
+        If `copy_to_ta_folders` left a manifest for a repository, only the
+        files the TA added, changed or deleted since then are applied to the
+        local repository.  Otherwise the whole TA folder is copied back.
+
         :param config: The Config object for the assignment
         :param ta_home: Path to home directory for all TA grading
         :param ta_dirname: Name of directory for this assignment
         :param basepath: Base path for local repositories to be copied to
+        :param jobs: Maximum number of repositories copied concurrently
+        :return: The repositories that received changes
         """
-        # cp all files except git stuff
-        for repo in config.repositories:
-            # compute target
-            target = config.pull_path(
-                basepath, repo, False, config.anonymize_sub_path)
-            # compute source; trailing slash is to force rsync to copy the
-            # CONTENTS of source dir into the target dir, not to copy source
-            # dir into the target dir
-            source = config.TA_target(ta_home, ta_dirname, repo) + "/"
+        # compute targets
+        targets = {repo: config.pull_path(basepath, repo, False,
+                                          config.anonymize_sub_path)
+                   for repo in config.repositories}
+        for target in targets.values():
             if not os.path.exists(target):
                 # abort if target directory is missing!
                 print(f"ERROR: Target submission directory {target} "
                       f"is missing! Aborting.", file=sys.stderr)
                 sys.exit(1)
-                # os.makedirs(target)
-            # copy to ta folder
+
+        # cp all files except git stuff
+        excludes = ExcludeFilter(
+            config.rsync_excludes +
+            [e for e in FEEDBACK_EXCLUDES if e not in config.rsync_excludes])
+
+        def copy(repo: str, out: List[str]) -> bool:
+            # compute source
+            source = config.TA_target(ta_home, ta_dirname, repo)
+            manifest = load_manifest(
+                Infrastructor.manifest_path(basepath, ta_dirname, source))
+            if manifest is None:
+                if config.verbose:
+                    out.append(f"Copying from {source} to {targets[repo]}\n")
+                Infrastructor.sync_folder(config, source, targets[repo],
+                                          excludes, out)
+                return True
             if config.verbose:
-                print(f"Copying from {source} to {target}")
-            call(
-                ["rsync",
-                 # changed flags to maintain permissions
-                 "-vurlptoD" if config.verbose else "-urlptoD",
-                 "--exclude=*/.git",
-                 "--exclude=*/.gitignore",
-                 "--exclude=*/*.class",
-                 source,
-                 target]
-            )
+                out.append(f"Copying changes from {source} to "
+                           f"{targets[repo]}\n")
+            return sync_changes(source, targets[repo], excludes, manifest,
+                                out if config.verbose else None) > 0
+
+        touched, failures = run_per_repo(copy, config.repositories, jobs)
+        report_failures(failures, "copy from TA folder")
+        print(f"{sum(touched.values())} of {len(targets)} repositories "
+              f"have feedback.")
+        return {repo for repo, changed in touched.items() if changed}
+
+    @staticmethod
+    def manifest_path(basepath: str, ta_dirname: str, ta_target: str) -> str:
+        """Returns where the manifest of a handed-out TA folder is kept
+
+        Manifests live with the (faculty-only) local repositories, not in the
+        TA folders.
+
+        :param basepath: Base path where local repositories are stored
+        :param ta_dirname: Name of directory for this assignment
+        :param ta_target: The repository's TA folder
+        :return: Path of the manifest file
+        """
+        return os.path.join(basepath, SYNC_STATE_DIR, "manifests", ta_dirname,
+                            os.path.basename(ta_target) + ".json")
+
+    @staticmethod
+    def sync_folder(config: Config, source: str, target: str,
+                    excludes: ExcludeFilter, out: List[str]) -> None:
+        """Copies the contents of one folder into another like
+        `rsync -urlptoD`, using the configured sync backend
+
+        :param config: The Config object for the assignment
+        :param source: Folder whose contents are copied
+        :param target: Folder to copy into
+        :param excludes: Compiled exclude patterns
+        :param out: Output buffer for this repository
+        :raises SyncFailed: if the builtin backend could not copy some files
+        :raises CommandFailed: if rsync fails
+        """
+        if config.sync_backend == "rsync":
+            run_logged(rsync_command(source, target, excludes,
+                                     config.verbose), out)
+        else:
+            sync_tree(source, target, excludes,
+                      out if config.verbose else None)
 
     @staticmethod
     def branch_exists(config: Config, rdir: str) -> bool:
@@ -246,80 +1102,83 @@ class Infrastructor(object):
         :return: If the feedback branch exists.
         """
         # check to see if FEEDBACK_BRANCH branch exists
-        proc = Popen(["git", "show-ref", "--verify", "--quiet",
-                      "refs/heads/" + config.feedback_branch],
-                     stdout=PIPE,
-                     stderr=PIPE,
-                     cwd=rdir)
-        proc.communicate()  # note: blocking; don't care about output
-        return proc.returncode == 0
+        return get_backend(config.git_backend).branch_exists(
+            rdir, config.feedback_branch)
 
     @staticmethod
-    def commit_changes(config: Config, basepath: str) -> None:
+    def commit_changes(config: Config, basepath: str,
+                       repos: Optional[Collection[str]] = None,
+                       jobs: int = 1) -> None:
         """Commits changes to the feedback branch in all repos
 
         :param config: The Config object for the assignment
         :param basepath: basepath for local path of repositories
+        :param repos: Only commit in these repositories, e.g., the ones
+                      returned by `copy_from_ta_folders`
+        :param jobs: Maximum number of repositories committed concurrently
         """
-        for repo in config.repositories:
+        git = get_backend(config.git_backend)
+
+        def commit(repo: str, out: List[str]) -> None:
             # get submissions dir path for repo
             rdir = config.pull_path(basepath, repo, False,
                                     config.anonymize_sub_path)
-            if not Infrastructor.branch_exists(config, rdir):
+            if not git.branch_exists(rdir, config.feedback_branch):
                 # create branch
                 if config.verbose:
-                    print(f"Creating new branch {config.feedback_branch}")
-                Popen(["git", "checkout", "-b", config.feedback_branch],
-                      cwd=rdir).wait()
+                    out.append(f"Creating new branch "
+                               f"{config.feedback_branch}\n")
+                git.create_branch(rdir, config.feedback_branch, out)
             else:
-                Popen(["git", "checkout", config.feedback_branch],
-                      cwd=rdir).wait()
-            # add any new files
-            if config.verbose:
-                print(f"Adding any new files in {rdir}")
-            Popen(["git", "add", "*"], cwd=rdir).wait()  # note: blocking
-            # commit
+                git.checkout(rdir, config.feedback_branch, out)
+            # add any new files and commit
             if config.verbose:
-                print("Committing feedback for " + rdir)
-            Popen(["git", "commit", "-am", "TA feedback"],
-                  cwd=rdir).wait()  # note: blocking
+                out.append("Committing feedback for " + rdir + "\n")
+            git.commit_all(rdir, "TA feedback", out)
+
+        _, failures = run_per_repo(
+            commit, [repo for repo in config.repositories
+                     if repos is None or repo in repos], jobs)
+        report_failures(failures, "commit")
 
     @staticmethod
     def issue_pull_request(config: Config, reponame: str,
-                           org: Organization) -> int:
+                           org: Organization,
+                           scheduler: Optional[ApiScheduler] = None) -> int:
         """Push local feedback branch to remote and issue pull request to the
         default branch for the specified repo
 
         :param config: The Config object for the assignment
         :param reponame: Name of the repository
         :param org: A github.Organization object
+        :param scheduler: Throttles and retries the GitHub API calls; pass
+                          the same scheduler when issuing many requests
         :return: an error number defined in errno; or 0 if no error.
+        :raises CommandFailed: if the feedback branch could not be pushed
         """
-        # extract basename
-        bn = os.path.basename(reponame)
+        api = scheduler or ApiScheduler(jobs=1)
 
         # get real repository name if hashed
-        repo = config.deanonymize_sha1_repo(bn) \
-            if config.anonymize_sub_path else bn
+        repo = config.resolve_repo(reponame)
 
         # get submissions dir path for repo
         rdir = config.pull_path(config.submission_path, reponame, False, False)
 
         # obtain handle to remote repository
-        grepo = org.get_repo(repo)
+        grepo = api.call(lambda: org.get_repo(repo))
 
         # ensure that the default branch exists on remote
-        remote_branches = []
-        for rb in grepo.get_branches():
-            remote_branches.append(rb.name)
+        remote_branches = api.call(
+            lambda: [rb.name for rb in grepo.get_branches()])
 
         if config.default_branch not in remote_branches:
-            print(f"ABORT: {config.default_branch} branch does not exist in remote repository.")
+            print(f"ABORT: {config.default_branch} branch does not exist in "
+                  f"remote repository {repo}.")
             return errno.ENOENT
 
         if config.feedback_branch in remote_branches:
             print(f"ABORT: {config.feedback_branch} branch already exists in "
-                  f"remote repository.")
+                  f"remote repository {repo}.")
             return errno.EEXIST
 
         if config.verbose:
@@ -328,8 +1187,14 @@ class Infrastructor(object):
         #### Lida: needed to edit since reponame contains the relative path, not just the name ####
         # Dan/Bill: not sure why this is necessary... hopefully we trigger it again and figure out why...
         # Popen(["git", "push", "origin", self.feedback_branch], cwd=reponame).wait()
-        Popen(["git", "push", "origin", config.feedback_branch],
-              cwd=rdir).wait()
+        # a failed push raises CommandFailed instead of opening a pull
+        # request for a branch that is not on the remote
+        out: List[str] = []
+        try:
+            run_logged(["git", "push", "origin", config.feedback_branch],
+                       out, cwd=rdir)
+        finally:
+            print("".join(out), end="")
 
         # create pull request
         if config.verbose:
@@ -338,14 +1203,85 @@ class Infrastructor(object):
 
         # push commits upstream
 
-        # we get the repo name from github so that you can run
+        # grepo was looked up by the repo name on github so that you can run
         # this command from other locations
-        grepo = org.get_repo(os.path.basename(repo))
-        grepo.create_pull(
+        api.call(lambda: grepo.create_pull(
             title="Feedback",
             base=config.default_branch,
             head=config.feedback_branch,
             body="Feedback on " + config.assignment_name +
                  " from " + config.course + " teaching staff."
-        )
+        ))
         return 0
+
+    @staticmethod
+    def issue_pull_requests(config: Config, repos: Sequence[str],
+                            client: GitHubClient,
+                            jobs: int = 1) -> Dict[str, int]:
+        """Push local feedback branches and issue pull requests for many
+        repositories, using batched GraphQL calls
+
+        A preflight query fetches the branch state of every repository in a
+        few requests and decides up front which repositories are eligible:
+        the default branch must exist on the remote and the feedback branch
+        must not.  Feedback branches are then pushed concurrently and the
+        pull requests are created in batched mutations.
+
+        :param config: The Config object for the assignment
+        :param repos: Names (not hashes) of the repositories
+        :param client: A GitHub API client
+        :param jobs: Maximum number of concurrent pushes
+        :return: A map from repository to an error number defined in errno;
+                 or 0 if no error.
+        """
+        status: Dict[str, int] = {}
+        states = branch_states(client, config.github_org, repos,
+                               config.default_branch, config.feedback_branch)
+        eligible = []
+        for repo in repos:
+            state = states.get(repo)
+            if state is None:
+                print(f"ABORT: {repo} does not exist in {config.github_org}.")
+                status[repo] = errno.ENOENT
+            elif not state.has_default:
+                print(f"ABORT: {config.default_branch} branch does not exist "
+                      f"in remote repository {repo}.")
+                status[repo] = errno.ENOENT
+            elif state.has_feedback:
+                print(f"ABORT: {config.feedback_branch} branch already exists "
+                      f"in remote repository {repo}.")
+                status[repo] = errno.EEXIST
+            else:
+                eligible.append(repo)
+
+        def push(repo: str, out: List[str]) -> None:
+            rdir = config.pull_path(config.submission_path, repo, False,
+                                    config.anonymize_sub_path)
+            if config.verbose:
+                out.append(f"Pushing branch {config.feedback_branch} of "
+                           f"{repo} to origin.\n")
+            run_logged(["git", "push", "origin", config.feedback_branch],
+                       out, cwd=rdir)
+
+        pushed, failures = run_per_repo(push, eligible, jobs)
+        report_failures(failures, "push")
+        for repo in failures:
+            status[repo] = errno.EIO
+
+        body = "Feedback on " + config.assignment_name + \
+               " from " + config.course + " teaching staff."
+        created = create_pull_requests(client, {
+            repo: {"repositoryId": states[repo].repo_id,
+                   "baseRefName": config.default_branch,
+                   "headRefName": config.feedback_branch,
+                   "title": "Feedback",
+                   "body": body}
+            for repo in pushed})
+        for repo, result in created.items():
+            if result.startswith("ERROR:"):
+                print(f"{repo}: pull request {result}", file=sys.stderr)
+                status[repo] = errno.EIO
+            else:
+                print(f"{repo}: {result}")
+                status[repo] = 0
+        return status
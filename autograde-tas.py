@@ -1,12 +1,189 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import os
+import shutil
+import signal
 import subprocess
+import sys
+import threading
+import time
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import argparse
 
+from Infrastructor import Infrastructor
 from config import Config
-from utils import self_check
+from filesync import ExcludeFilter, Manifest, build_manifest, copy_file, \
+    load_manifest, manifest_digest, save_manifest, sync_tree
+from utils import SYNC_STATE_DIR, report_failures, run_logged, run_per_repo, \
+    self_check
+
+CHUNK_SIZE = 1 << 16
+"Number of bytes of command output read and written at a time"
+
+
+class GradeResult(NamedTuple):
+    """The outcome of running the command in one TA folder"""
+    returncode: int
+    "Exit status of the command; negative if it was killed by a signal"
+    duration: float
+    "Wall-clock seconds the command ran"
+    output_bytes: int
+    "Number of output bytes the command produced"
+    timed_out: bool
+    "Whether the command was killed for exceeding the time limit"
+    truncated: bool
+    "Whether output beyond the size limit was dropped"
+    cached: bool = False
+    "Whether the result was taken from the result cache"
+
+
+class ResultCache(object):
+    """Stores the output and outcome of grading runs by a key derived from
+    the graded files and the grading command
+
+    Each entry is a `<key>.out` file holding the output that was appended
+    to the output file, and a `<key>.json` file holding the `GradeResult`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        "Folder holding the cache entries"
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Tuple[GradeResult, bytes]]:
+        """Looks up an entry
+
+        :param key: The key of the entry
+        :return: The result and output, or None on a cache miss
+        """
+        try:
+            with open(os.path.join(self.path, key + ".json"), 'r') as f:
+                fields = json.load(f)
+            with open(os.path.join(self.path, key + ".out"), 'rb') as f:
+                output = f.read()
+        except (OSError, ValueError):
+            return None
+        return GradeResult(**fields)._replace(cached=True), output
+
+    def put(self, keys: Sequence[str], result: GradeResult,
+            output: bytes) -> None:
+        """Stores an entry under one or more keys
+
+        :param keys: The keys of the entry
+        :param result: The outcome of the run
+        :param output: The output the run appended to the output file
+        """
+        # the .json file is written last; it marks a complete entry
+        for key in set(keys):
+            for ext, data in ((".out", output),
+                              (".json", json.dumps(result._asdict())
+                               .encode('utf-8'))):
+                path = os.path.join(self.path, key + ext)
+                tmp = f"{path}.{threading.get_ident()}"
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+
+
+def grading_key(manifest: Manifest, settings: str) -> str:
+    """Returns the result cache key for grading a folder
+
+    :param manifest: The files of the folder
+    :param settings: The grading command and limits
+    :return: The key
+    """
+    return hashlib.sha1((settings + "\0" + manifest_digest(manifest))
+                        .encode('utf-8')).hexdigest()
+
+
+def prebuild(conf: Config, command: str, excludes: ExcludeFilter,
+             basepath: str) -> Tuple[str, Manifest]:
+    """Runs a build command once in a clone of the starter repository
+
+    The build is kept, keyed on the tip of the starter repository's
+    `default_branch` and the command, so later runs reuse it.
+
+    :param conf: The Config object for the assignment
+    :param command: The build command, e.g., "make"
+    :param excludes: Files that are not part of a submission
+    :param basepath: Folder in which builds are kept
+    :return: The path of the built tree and a manifest of the starter files
+             it was built from
+    """
+    # whatever happens to be checked out in the starter repository is not
+    # necessarily what students started from
+    head = subprocess.run(["git", "rev-parse", "--verify", "--quiet",
+                           f"refs/heads/{conf.default_branch}^{{commit}}"],
+                          stdout=subprocess.PIPE, universal_newlines=True,
+                          cwd=conf.starter_repo).stdout.strip()
+    if not head:
+        print(f"ERROR: {conf.default_branch} branch does not exist in "
+              f"{conf.starter_repo}", file=sys.stderr)
+        sys.exit(1)
+    key = hashlib.sha1(f"{head}\0{command}".encode('utf-8')).hexdigest()
+    build_dir = os.path.join(basepath, key)
+    tree = os.path.join(build_dir, "tree")
+    manifest_file = os.path.join(build_dir, "manifest.json")
+    done = os.path.join(build_dir, "done")
+
+    if not os.path.exists(done):
+        print(f"building {command!r} in starter {head[:7]}")
+        shutil.rmtree(build_dir, ignore_errors=True)
+        out: List[str] = []
+        try:
+            run_logged(["git", "clone", "--quiet", "--branch",
+                        conf.default_branch, conf.starter_repo, tree], out)
+            # describe the sources before the build adds anything
+            save_manifest(manifest_file, build_manifest(tree, excludes))
+            run_logged(command.split(), out, cwd=tree)
+        finally:
+            print("".join(out), end="")
+        open(done, 'w').close()
+
+    manifest = load_manifest(manifest_file)
+    assert manifest is not None
+    return tree, manifest
+
+
+def overlay(conf: Config, build: str, starter: Manifest,
+            submission: Manifest, source: str, scratch: str) -> None:
+    """Lays a submission over a copy of the prebuilt starter tree
+
+    Files whose content matches the starter keep the prebuilt copy and its
+    modification time, so build tools only rebuild what the student changed.
+
+    :param conf: The Config object for the assignment
+    :param build: The prebuilt starter tree
+    :param starter: Manifest of the starter files the tree was built from
+    :param submission: Manifest of the submission
+    :param source: Folder holding the submission
+    :param scratch: Folder to create the overlay in; replaced if it exists
+    """
+    shutil.rmtree(scratch, ignore_errors=True)
+    # the build's clone metadata is not part of what is graded
+    sync_tree(build, scratch, ExcludeFilter([".git"]))
+    now = time.time_ns()
+    for relpath, (_, _, sha1) in submission.items():
+        old = starter.get(relpath)
+        if old is not None and old[2] == sha1:
+            continue
+        dst = os.path.join(scratch, relpath)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        copy_file(os.path.join(source, relpath), dst)
+        # newer than anything the build produced
+        os.utime(dst, ns=(now, now))
+    # starter files the student deleted; files outside `sparse_paths` were
+    # never checked out, so the starter's copy is kept
+    for relpath in starter.keys() - submission.keys():
+        if not conf.is_checked_out(relpath):
+            continue
+        path = os.path.join(scratch, relpath)
+        if os.path.lexists(path):
+            os.unlink(path)
 
 
 def dump_file(fname: str) -> None:
@@ -15,6 +192,110 @@ def dump_file(fname: str) -> None:
             print(line, end='')
 
 
+def limit_memory(command: List[str], limit: int) -> List[str]:
+    """Wraps a command so that its address space is capped before it starts
+
+    `prlimit` sets the limit and then execs the command, so no Python code
+    runs in the child (a `preexec_fn` is unsafe while grading threads run).
+
+    :param command: The command and its arguments
+    :param limit: Maximum address space in bytes
+    :return: The wrapped command
+    """
+    return ["prlimit", f"--as={limit}", "--"] + command
+
+
+def run_command(command: List[str], cwd: str, output_file: str,
+                timeout: Optional[float] = None,
+                memory: Optional[int] = None,
+                max_output: Optional[int] = None) -> GradeResult:
+    """Runs a command, streaming its combined stdout/stderr to the end of a
+    file
+
+    :param command: The command and its arguments
+    :param cwd: Directory to run the command in
+    :param output_file: File that the output is appended to
+    :param timeout: Seconds after which the command (and every process it
+                    started) is killed, or None for no limit
+    :param memory: Address space limit for the command in bytes, or None
+    :param max_output: Number of output bytes kept, or None for no limit
+    :return: The outcome
+    """
+    start = time.monotonic()
+    timed_out = threading.Event()
+    # a new session lets us kill the whole process group on timeout
+    if memory is not None:
+        command = limit_memory(command, memory)
+    with subprocess.Popen(args=command,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          cwd=cwd,
+                          bufsize=0,
+                          start_new_session=True) as proc:
+
+        def kill() -> None:
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer is not None:
+            timer.start()
+
+        stdout = proc.stdout
+        assert stdout is not None
+        total = 0
+        written = 0
+        try:
+            with open(output_file, 'ab') as fout:
+                # unbuffered, so read() returns whatever is available
+                for chunk in iter(partial(stdout.read, CHUNK_SIZE), b""):
+                    total += len(chunk)
+                    if max_output is not None:
+                        # keep draining the pipe so the command never blocks
+                        chunk = chunk[:max(0, max_output - written)]
+                    fout.write(chunk)
+                    written += len(chunk)
+                if written < total:
+                    fout.write(f"\n[output truncated: {total} bytes, "
+                               f"{written} kept]\n".encode('utf-8'))
+                if timed_out.is_set():
+                    fout.write(f"\n[killed after {timeout} seconds]\n"
+                               .encode('utf-8'))
+            returncode = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    return GradeResult(returncode, time.monotonic() - start, total,
+                       timed_out.is_set(), written < total)
+
+
+def print_summary(results: Dict[str, GradeResult],
+                  failures: Dict[str, Exception], repos: List[str]) -> None:
+    """Prints a table of the exit status, duration and output size of every
+    repository
+
+    :param results: The outcome of each repository that was graded
+    :param failures: Repositories that could not be graded
+    :param repos: All repositories, in the order they are listed
+    """
+    width = max([len(r) for r in repos] + [len("repository")])
+    print(f"{'repository':<{width}}  {'status':>8}  {'seconds':>8}  "
+          f"{'output':>10}  cache")
+    for repo in repos:
+        if repo in failures:
+            print(f"{repo:<{width}}  {'ERROR':>8}")
+            continue
+        r = results[repo]
+        status = "TIMEOUT" if r.timed_out else str(r.returncode)
+        output = f"{r.output_bytes}{'+' if r.truncated else ''}"
+        print(f"{repo:<{width}}  {status:>8}  {r.duration:>8.1f}  "
+              f"{output:>10}  {'hit' if r.cached else ''}")
+
+
 def main() -> None:
     # get config
     parser = argparse.ArgumentParser(
@@ -30,24 +311,105 @@ def main() -> None:
                         help='File (in each repo) where output is stored.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of repositories graded at the same time '
+                             '(default: 1)')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='wall-clock limit per repository in seconds; '
+                             'the command and its children are killed when '
+                             'it runs out')
+    parser.add_argument('-m', '--memory', type=int, default=None,
+                        help='address space limit per command in MB')
+    parser.add_argument('--max-output', type=int, default=None,
+                        help='maximum number of output bytes stored per '
+                             'repository')
+    parser.add_argument('--invalidate', action='store_true',
+                        help='ignore cached results and grade every '
+                             'repository again')
+    parser.add_argument('--prebuild', type=str, default=None,
+                        metavar='CMD',
+                        help='build command run once in a clone of the '
+                             'starter repo; each submission is then graded '
+                             'in a copy of that build with its changed '
+                             'files laid over it')
 
     args = parser.parse_args()
 
     self_check()
+    if args.memory is not None and shutil.which("prlimit") is None:
+        print("ERROR: Cannot find prlimit (util-linux), needed for --memory.",
+              file=sys.stderr)
+        sys.exit(1)
     conf = Config(args.config, args.verbose)
+    memory = args.memory * 1024 * 1024 if args.memory is not None else None
 
-    # basepath = conf.ta_path
-    for repo in conf.repositories:
+    # results are cached by the graded files plus everything that affects
+    # the output; the output file itself is not graded
+    cache = ResultCache(os.path.join(conf.submission_path, SYNC_STATE_DIR,
+                                     "autograde"))
+    excludes = ExcludeFilter(conf.rsync_excludes +
+                             [".git", "/" + args.output_file])
+    settings = "\0".join([args.command, f"timeout={args.timeout}",
+                          f"memory={memory}",
+                          f"max_output={args.max_output}"])
+
+    state_dir = os.path.join(conf.submission_path, SYNC_STATE_DIR)
+    build: Optional[Tuple[str, Manifest]] = None
+    if args.prebuild is not None:
+        build = prebuild(conf, args.prebuild, excludes,
+                         os.path.join(state_dir, "prebuild"))
+        settings += "\0prebuild=" + os.path.basename(
+            os.path.dirname(build[0]))
+
+    def grade(repo: str, out: List[str]) -> GradeResult:
         ta_dir = conf.TA_target(conf.ta_path, conf.assignment_name, repo)
-        print(f"{repo}: {ta_dir}")
-        with subprocess.Popen(args=args.command.split(),
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              cwd=ta_dir) as proc:
-            output = proc.stdout.read()
-            with open(os.path.join(ta_dir, args.output_file), 'a') as fout:
-                print(output, file=fout)
+        out.append(f"{repo}: {ta_dir}\n")
+        output_file = os.path.join(ta_dir, args.output_file)
+
+        # the hand-out manifest saves re-reading files TAs did not touch
+        before = build_manifest(ta_dir, excludes, load_manifest(
+            Infrastructor.manifest_path(conf.submission_path,
+                                        conf.assignment_name, ta_dir)))
+        key = grading_key(before, settings)
+        cached = None if args.invalidate else cache.get(key)
+        if cached is not None:
+            result, output = cached
+            with open(output_file, 'ab') as fout:
+                fout.write(output)
+            out.append("unchanged since last graded; using cached result\n")
+            return result
+
+        offset = os.path.getsize(output_file) \
+            if os.path.exists(output_file) else 0
+        if build is None:
+            result = run_command(args.command.split(), ta_dir, output_file,
+                                 args.timeout, memory, args.max_output)
+        else:
+            # grade in a scratch copy; build output stays out of TA folders
+            scratch = os.path.join(state_dir, "scratch",
+                                   os.path.basename(ta_dir))
+            overlay(conf, build[0], build[1], before, ta_dir, scratch)
+            try:
+                result = run_command(args.command.split(), scratch,
+                                     output_file, args.timeout, memory,
+                                     args.max_output)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+        # a timeout may just mean the machine was busy
+        if not result.timed_out:
+            with open(output_file, 'rb') as f:
+                f.seek(offset)
+                output = f.read()
+            # also store under the key of the folder as the command left it
+            # (e.g., with build artifacts), so that the next run hits
+            after = build_manifest(ta_dir, excludes, before)
+            cache.put([key, grading_key(after, settings)], result, output)
+        return result
+
+    repos = conf.repositories
+    results, failures = run_per_repo(grade, repos, args.jobs)
+    print_summary(results, failures, repos)
+    report_failures(failures, "autograde")
 
 
 if __name__ == "__main__":
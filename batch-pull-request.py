@@ -5,8 +5,8 @@ from github import Github
 
 from Infrastructor import Infrastructor
 from config import Config
-from utils import self_check
-from time import sleep
+from github_api import DEFAULT_API_URL, ApiScheduler, GitHubClient
+from utils import report_failures, self_check
 
 
 def main() -> None:
@@ -20,31 +20,60 @@ def main() -> None:
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-g', '--graphql', action='store_true',
+                        help='check branches and create pull requests for '
+                             'all repositories in batched GraphQL calls')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of repositories processed '
+                             'concurrently (default: 4)')
+    parser.add_argument('--api-url', type=str, default=DEFAULT_API_URL,
+                        help='GitHub API URL (default: %(default)s)')
 
     args = parser.parse_args()
     # get config
     self_check()
     conf = Config(args.config, args.verbose)
 
+    if args.graphql:
+        repos = []
+        for repo in conf.repositories:
+            rdir = conf.pull_path(conf.submission_path, repo, False,
+                                  conf.anonymize_sub_path)
+            if not Infrastructor.branch_exists(conf, rdir):
+                print(f"No feedback branch for {rdir}")
+                continue
+            repos.append(repo)
+        client = GitHubClient(args.user, args.password, args.api_url,
+                              ApiScheduler(args.jobs))
+        Infrastructor.issue_pull_requests(conf, repos, client, args.jobs)
+        return
+
     # init Github SDK
     g = Github(args.user, args.password)
+    # Github aggressively rate-limits; the scheduler paces all API calls
+    # by the rate limit headers instead of sleeping
+    scheduler = ApiScheduler(args.jobs, g)
     # guser = g.get_user()
-    org = g.get_organization("williams-cs")
+    org = scheduler.call(lambda: g.get_organization("williams-cs"))
 
     # TODO: verify that local repo is on the correct branch
     basepath = conf.submission_path
+    rdirs = []
     for repo in conf.repositories:
         # get submissions dir path for repo
         rdir = conf.pull_path(basepath, repo, False, conf.anonymize_sub_path)
         if not Infrastructor.branch_exists(conf, rdir):
             print(f"No feedback branch for {rdir}")
             continue
+        rdirs.append(rdir)
+
+    def issue(rdir: str) -> int:
         # issue pull request for given repo
         print(f"issuing pull request for {rdir}")
-        Infrastructor.issue_pull_request(conf, rdir, org)
-        
-        # Github aggressively rate-limits; sleep to avoid pain
-        sleep(1)
+        return Infrastructor.issue_pull_request(conf, rdir, org, scheduler)
+
+    _, failures = scheduler.map(issue, rdirs)
+    report_failures(failures, "pull request")
 
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ from github import GithubException
 
 from Infrastructor import Infrastructor
 from config import Config
+from github_api import ApiScheduler
 from utils import self_check
 
 
@@ -27,6 +28,9 @@ def main() -> None:
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of repositories deleted concurrently '
+                             '(default: 4)')
 
     args = parser.parse_args()
 
@@ -44,21 +48,30 @@ def main() -> None:
 
     # connect to github
     g = Github(args.user, args.password)
+    scheduler = ApiScheduler(args.jobs, g)
     # guser = g.get_user()
-    org = g.get_organization("williams-cs")
+    org = scheduler.call(lambda: g.get_organization("williams-cs"))
 
+    # ask about every repository first, then delete concurrently
+    doomed = []
     for repo_name, group in conf.repo2group.items():
         # repo = None
         try:
             # check to see if repository already exists
-            repo = org.get_repo(repo_name)
+            repo = scheduler.call(lambda: org.get_repo(repo_name))
             ans = input(f"delete repository {repo_name}? (y/n) ")
             if ans == "y":
-                repo.delete()
+                doomed.append(repo)
         except GithubException:
             print(f"GitHubException. "
                   f"We could not delete repository {repo_name}")
 
+    _, failures = scheduler.map(
+        lambda repo: scheduler.call(lambda: repo.delete()), doomed)
+    for repo in failures:
+        print(f"GitHubException. "
+              f"We could not delete repository {repo.name}")
+
 
 if __name__ == "__main__":
     main()
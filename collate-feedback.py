@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 
+import csv
+import json
 import os
+import re
+import sys
+from typing import Any, Dict, List, Optional
 
 import argparse
 
-from Infrastructor import Infrastructor
 from config import Config
-from utils import self_check
+from gitbackend import get_backend
+from utils import report_failures, run_per_repo, self_check
 
+DEFAULT_PATTERN = r"(?im)^\W*(?:total\s+)?(?:score|grade)\W*\s*" \
+                  r"(?P<score>[-+]?\d+(?:\.\d+)?)"
+"Finds lines like `Score: 17` or `**Total grade** = 9.5`"
 
-def dump_file(fname: str) -> None:
-    with open(fname, 'r') as fin:
-        for line in fin:
-            print(line, end='')
+
+def extract(pattern: re.Pattern, text: Optional[str]
+            ) -> Dict[str, Optional[str]]:
+    """Extracts the named groups of the first match of `pattern`
+
+    :param pattern: A compiled pattern; a pattern without named groups
+                    yields its first group (or whole match) as "score"
+    :param text: The feedback, or None if there is none
+    :return: The value of each named group, None where nothing matched
+    """
+    names = list(pattern.groupindex) or ["score"]
+    m = pattern.search(text) if text is not None else None
+    if m is None:
+        return {name: None for name in names}
+    if pattern.groupindex:
+        return m.groupdict()
+    return {"score": m.group(1) if pattern.groups else m.group(0)}
 
 
 def main() -> None:
@@ -28,33 +49,88 @@ def main() -> None:
                              'README.md)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-f', '--format', default='markdown',
+                        choices=['markdown', 'csv', 'json'],
+                        help='output format (default: markdown)')
+    parser.add_argument('-p', '--pattern', type=str, default=DEFAULT_PATTERN,
+                        help='regular expression for score lines; each '
+                             'named group becomes a column in csv/json '
+                             'output (default finds "Score: N")')
+    parser.add_argument('-b', '--branch', action='store_true',
+                        help='read the feedback file from the tip of the '
+                             'feedback branch instead of the checked-out '
+                             'files')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='number of repositories read at the same time '
+                             '(default: 8)')
 
     args = parser.parse_args()
 
     self_check()
     conf = Config(args.config, args.verbose)
+    pattern = re.compile(args.pattern)
+    backend = get_backend(conf.git_backend)
 
-    for student in sorted(conf.list_of_users):
-        repo = conf.lookupRepo(student)
-
+    def rdir_of(repo: str) -> str:
         # get submissions dir path for repo
-        rdir = conf.pull_path(conf.submission_path, repo, False,
+        return conf.pull_path(conf.submission_path, repo, False,
                               conf.anonymize_sub_path)
 
-        # all graded labs should have a feedback branch
-        # if not infra.branch_exists(rdir):
-        #     print("\n\n")
-        #     print("# ERROR for {}".format(student))
-        #     print("# No feedback branch in {}".format(rdir))
-        #     print("\n\n")
-        #     continue
-
-        # dump username and README.md contents to stdout
-        print(f"# BEGIN {student} FEEDBACK")
-        print(f"__({rdir})__")
-        dump_file(os.path.join(rdir, args.feedback_file))
-        print(f"## END {student} FEEDBACK")
-        print("\n\n")
+    def read(repo: str, out: List[str]) -> Optional[str]:
+        rdir = rdir_of(repo)
+        if args.branch:
+            # straight from the branch tip; nothing is checked out
+            data = backend.read_blob(rdir, conf.feedback_branch,
+                                     args.feedback_file)
+        else:
+            path = os.path.join(rdir, args.feedback_file)
+            if not os.path.exists(path):
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+        return data.decode('utf-8', errors='replace') \
+            if data is not None else None
+
+    feedback, failures = run_per_repo(read, conf.repositories, args.jobs)
+    report_failures(failures, "collate")
+
+    students = sorted(conf.list_of_users)
+    if args.format == 'markdown':
+        for student in students:
+            repo = conf.lookupRepo(student)
+            rdir = rdir_of(repo)
+            text = feedback.get(repo)
+            # dump username and feedback contents to stdout
+            print(f"# BEGIN {student} FEEDBACK")
+            print(f"__({rdir})__")
+            if text is None:
+                where = conf.feedback_branch if args.branch else "disk"
+                print(f"# ERROR: No {args.feedback_file} on {where} in "
+                      f"{rdir}")
+            else:
+                print(text, end='')
+            print(f"## END {student} FEEDBACK")
+            print("\n\n")
+        return
+
+    rows = {}
+    for student in students:
+        repo = conf.lookupRepo(student)
+        row: Dict[str, Any] = {"repository": repo}
+        row.update(extract(pattern, feedback.get(repo)))
+        row["has_feedback"] = feedback.get(repo) is not None
+        rows[student] = row
+
+    if args.format == 'json':
+        print(json.dumps(rows, indent=2))
+        return
+
+    fields = ["student", "repository"] + \
+        (list(pattern.groupindex) or ["score"]) + ["has_feedback"]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+    writer.writeheader()
+    for student, row in rows.items():
+        writer.writerow(dict(row, student=student))
 
 
 if __name__ == "__main__":
@@ -16,11 +16,14 @@ def main() -> None:
 
 
 # copy every commented assignment from TA location to submissions folder
-    Infrastructor.copy_from_ta_folders(conf, conf.ta_path, conf.assignment_name,
-                                       conf.submission_path)
-
-    # commit changes
-    Infrastructor.commit_changes(conf, conf.submission_path)
+    touched = Infrastructor.copy_from_ta_folders(conf, conf.ta_path,
+                                                 conf.assignment_name,
+                                                 conf.submission_path,
+                                                 args.jobs)
+
+    # commit changes in the repositories TAs actually touched
+    Infrastructor.commit_changes(conf, conf.submission_path, touched,
+                                 args.jobs)
 
 
 if __name__ == "__main__":
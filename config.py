@@ -1,12 +1,71 @@
 import datetime
 import hashlib
 import json
+import marshal
+import os
 import os.path
 import random
 import sys
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
-from utils import canonical_group_name, java_string_hashcode, round_robin_map
+from filesync import ExcludeFilter, walk_files
+from utils import SYNC_STATE_DIR, canonical_group_name, \
+    java_string_hashcode, rendezvous_map, round_robin_map
+
+CACHE_VERSION = 2
+"Version of the compiled config cache format; bump when Config changes"
+
+_CACHED_FIELDS = ("user2repo", "repo2group", "ta_assignments", "repo2sha1",
+                  "sha12repo")
+
+
+def cache_dir() -> str:
+    """Returns the folder that holds compiled configs,
+    `$XDG_CACHE_HOME/infrastructor` (by default `~/.cache/infrastructor`)
+
+    :return: Path to the cache folder
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "infrastructor")
+
+
+def _cache_key(path: str) -> Tuple[str, str]:
+    abspath = os.path.abspath(path)
+    name = hashlib.sha1(abspath.encode('utf-8')).hexdigest() + ".marshal"
+    return abspath, os.path.join(cache_dir(), name)
+
+
+def _load_compiled(path: str, st: os.stat_result) -> Optional[Dict[str, Any]]:
+    abspath, cpath = _cache_key(path)
+    try:
+        with open(cpath, 'rb') as f:
+            version, cached_path, mtime, size, compiled = \
+                marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (version, cached_path, mtime, size) != \
+            (CACHE_VERSION, abspath, st.st_mtime_ns, st.st_size):
+        return None
+    return compiled
+
+
+def _save_compiled(path: str, st: os.stat_result,
+                   compiled: Dict[str, Any]) -> None:
+    abspath, cpath = _cache_key(path)
+    tmp = f"{cpath}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(marshal.dumps((CACHE_VERSION, abspath, st.st_mtime_ns,
+                                   st.st_size, compiled)))
+        os.replace(tmp, cpath)
+    except OSError:
+        # the cache is only an optimization, e.g., HOME may be read-only
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
 
 
 class Config(object):
@@ -48,9 +107,11 @@ class Config(object):
         user2repo (Dict[str, str]): A dictionary mapping user to their repository name.
         repo2group (Dict[str, List[str]]): A dictionary mapping repo name to the list of students (assuming group assignment). The list will be length 1 if individual assignment.
         ta_assignments (Dict[str, str]): A dictionary mapping each repository to the grading TAs.
+        repo2sha1 (Dict[str, str]): A dictionary mapping repo name to its anonymized (SHA1) name.
+        sha12repo (Dict[str, str]): A dictionary mapping anonymized (SHA1) repo name back to the repo name.
         course (str): The name of the course.
         assignment_name (str): The name of the assignment
-        starter_repo (str): Path to starter repo.  Starter code is distributed by setting each student repository as a "remote" for the starter repository and then `push`ing.  Student repositories _must_ be empty (i.e., no `main` branch) otherwise `push` will fail.
+        starter_repo (str): Path to starter repo.  Starter code is distributed by `push`ing the starter repository's default branch to each student repository.  Student repositories _must_ be empty (i.e., no `main` branch) otherwise `push` will fail.
         github_org (str): Name of the GitHub organization to use.
         archive_path (str): Path to folder intended as deanonymized repository of student submissions for Academic Honor Code cases.
         submission_path (str): Path to faculty-only staging area for squashing and modifying TA feedback before issuing pull requests.
@@ -60,16 +121,31 @@ class Config(object):
         due_date (int): Optional. a UNIX timestamp representing the due date in the local timezone.
         anonymize_sub_path (bool): whether the contents of the `submissions` folder, which is viewable only by faculty (not TAs), is anonymized.
         rsync_excludes (List[str]): List of files & directories to be excluded from rsync when copying to TA folder.
+        sync_backend (str): How folders are copied to and from TA folders: `builtin` (in-process, the default) or `rsync`.
+        git_backend (str): How local git queries and commits are done: `subprocess` (the default) or `dulwich` (in-process; requires the `dulwich` package).
+        ta_assignment (str): How repositories are assigned to TAs: `shuffle` (the default) or `rendezvous` (stable when the roster changes).
+        ta_weight (str): With `rendezvous`, balance TA workloads by the number of `files` or `lines` in each archived submission, or `none` (the default).  The weighted assignment is computed once, at the first hand-out, and saved.
+        clone_filter (str): Optional. A `git clone --filter` spec, e.g., `blob:limit=1m`, for submission clones; large blobs are then fetched only when needed.  Archive clones are always full.
+        sparse_paths (List[str]): Optional. Directories that are checked out in submission clones (and therefore copied to TA folders); files at the top level are always included.  By default everything is checked out.  Not supported with the `dulwich` git backend.
+        share_starter_objects (bool): Whether clones borrow the starter commits from a shared object store built from `starter_repo` instead of downloading and storing them once per repository.  Defaults to `false`.
     """
 
-    def __init__(self, json_conf_file: str, verbosity: bool):
+    def __init__(self, json_conf_file: str, verbosity: bool,
+                 use_cache: bool = True):
 
-        # open config file
-        with open(json_conf_file, 'r') as f:
-            # read config
-            conf = json.loads(f.read())
-            self.jsondict = conf
-            "A dictionary object for parsed configuration file"
+        # load the compiled config if the JSON has not changed since
+        st = os.stat(json_conf_file)
+        compiled = _load_compiled(json_conf_file, st) if use_cache else None
+
+        if compiled is not None:
+            conf = compiled["jsondict"]
+        else:
+            # open config file
+            with open(json_conf_file, 'r') as f:
+                # read config
+                conf = json.loads(f.read())
+        self.jsondict = conf
+        "A dictionary object for parsed configuration file"
 
         # declare/init fields
 
@@ -95,6 +171,16 @@ class Config(object):
         self.ta_assignments: Dict[str, str] = {}
         "A dictionary mapping each repository to the grading TAs."
 
+        self.repo2sha1: Dict[str, str] = {}
+        """A dictionary mapping repo name to its anonymized (SHA1) name."""
+
+        self.sha12repo: Dict[str, str] = {}
+        """A dictionary mapping anonymized (SHA1) repo name back to the repo
+        name."""
+
+        self._paths: Dict[Tuple[str, ...], str] = {}
+        "Memoized results of pull_path and TA_target"
+
         self.course: str = conf["course"]
         "The name of the course."
 
@@ -103,10 +189,10 @@ class Config(object):
 
         self.starter_repo: str = conf["starter_repo"]
         """
-        Path to starter repo.  Starter code is distributed by setting each
-        student repository as a "remote" for the starter repository and then
-        `push`ing.  Student repositories _must_ be empty (i.e., no `main`
-        branch) otherwise `push` will fail.
+        Path to starter repo.  Starter code is distributed by `push`ing the
+        starter repository's default branch to each student repository.
+        Student repositories _must_ be empty (i.e., no `main` branch)
+        otherwise `push` will fail.
         """
 
         self.github_org: str = conf["github_org"]
@@ -147,20 +233,187 @@ class Config(object):
         """List of files & directories to be excluded from rsync when copying
         to TA folder."""
 
+        self.sync_backend: str = conf["sync_backend"] \
+            if "sync_backend" in conf else "builtin"
+        """How folders are copied to and from TA folders: `builtin`
+        (in-process, the default) or `rsync`."""
+        if self.sync_backend not in ("builtin", "rsync"):
+            print(f"ERROR: Unknown sync_backend '{self.sync_backend}'.",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        self.git_backend: str = conf["git_backend"] \
+            if "git_backend" in conf else "subprocess"
+        """How local git queries and commits are done: `subprocess` (the
+        default) or `dulwich` (in-process; requires the `dulwich` package)."""
+        if self.git_backend not in ("subprocess", "dulwich"):
+            print(f"ERROR: Unknown git_backend '{self.git_backend}'.",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        self.ta_assignment: str = conf["ta_assignment"] \
+            if "ta_assignment" in conf else "shuffle"
+        """How repositories are assigned to TAs: `shuffle` (the default) or
+        `rendezvous` (stable when the roster changes)."""
+        if self.ta_assignment not in ("shuffle", "rendezvous"):
+            print(f"ERROR: Unknown ta_assignment '{self.ta_assignment}'.",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        self.ta_weight: str = conf["ta_weight"] \
+            if "ta_weight" in conf else "none"
+        """With `rendezvous`, balance TA workloads by the number of `files`
+        or `lines` in each archived submission, or `none` (the default).
+        The weighted assignment is computed once, at the first hand-out, and
+        saved."""
+        if self.ta_weight not in ("none", "files", "lines"):
+            print(f"ERROR: Unknown ta_weight '{self.ta_weight}'.",
+                  file=sys.stderr)
+            sys.exit(1)
+        if self.ta_weight != "none" and self.ta_assignment != "rendezvous":
+            print("ERROR: ta_weight requires \"ta_assignment\": "
+                  "\"rendezvous\".", file=sys.stderr)
+            sys.exit(1)
+
+        self.clone_filter: Optional[str] = conf["clone_filter"] \
+            if "clone_filter" in conf else None
+        """A `git clone --filter` spec, e.g., `blob:limit=1m`, for
+        submission clones; large blobs are then fetched only when needed.
+        Archive clones are always full."""
+
+        self.sparse_paths: List[str] = conf["sparse_paths"] \
+            if "sparse_paths" in conf else []
+        """Directories that are checked out in submission clones (and
+        therefore copied to TA folders); files at the top level are always
+        included.  By default everything is checked out."""
+        # sparse checkouts turn on the worktreeConfig extension, which
+        # dulwich refuses to open
+        if self.sparse_paths and self.git_backend == "dulwich":
+            print("ERROR: sparse_paths requires \"git_backend\": "
+                  "\"subprocess\".", file=sys.stderr)
+            sys.exit(1)
+
+        self.share_starter_objects: bool = conf["share_starter_objects"] \
+            if "share_starter_objects" in conf else False
+        """Whether clones borrow the starter commits from a shared object
+        store built from `starter_repo` instead of downloading and storing
+        them once per repository.  Defaults to `false`."""
+
+        if compiled is not None:
+            for field in _CACHED_FIELDS:
+                if field in compiled:
+                    setattr(self, field, compiled[field])
+            if "ta_assignments" not in compiled:
+                self.assign_tas()
+            return
+
         # populate mappings (user2repo, repo2group)
         for student in conf["repository_map"].keys():
             self.add_mapping(student, conf["repository_map"][student])
 
+        self.assign_tas()
+
+        if use_cache:
+            compiled = {field: getattr(self, field)
+                        for field in _CACHED_FIELDS}
+            # a weighted assignment is saved at hand-out, after the JSON
+            if self.ta_weight != "none":
+                del compiled["ta_assignments"]
+            compiled["jsondict"] = conf
+            _save_compiled(json_conf_file, st, compiled)
+
+    def assign_tas(self) -> None:
+        """(Re)computes `ta_assignments`
+
+        With `ta_weight`, the assignment saved by `weigh_tas` is used; only
+        repositories added since then (or all of them, before the first
+        hand-out) and those of TAs no longer in the TA list are assigned
+        without weights.
+        """
         # read TA list
-        tas: List[str] = conf["TAs"]
+        tas: List[str] = self.jsondict["TAs"]
         tas.sort()  # sorting ensures that TA order is deterministic
 
+        if self.ta_assignment == "rendezvous":
+            self.ta_assignments = rendezvous_map(tas, self.repositories)
+            path = self.ta_assignments_file
+            if self.ta_weight != "none" and os.path.exists(path):
+                with open(path, 'r') as f:
+                    saved: Dict[str, str] = json.load(f)
+                self.ta_assignments.update(
+                    (repo, ta) for repo, ta in saved.items()
+                    if repo in self.ta_assignments and ta in tas)
+            return
+
         # generate TA map
-        random.seed(java_string_hashcode(conf["assignment_name"]))
+        random.seed(java_string_hashcode(self.assignment_name))
         repos = self.repositories
         random.shuffle(repos)
         self.ta_assignments = round_robin_map(tas, repos)
 
+    @property
+    def ta_assignments_file(self) -> str:
+        """Returns where `weigh_tas` saves the weighted TA assignment
+
+        :rtype: str
+        :return: Path to the file
+        """
+        return os.path.join(self.submission_path, SYNC_STATE_DIR,
+                            "ta_assignments.json")
+
+    def weigh_tas(self) -> bool:
+        """Computes the `ta_weight`ed TA assignment from the archive and
+        saves it, unless one was saved before
+
+        Call this once the archive is up to date and before repositories
+        are copied to TA folders.  The saved assignment is kept from then
+        on, so that every repository stays in the folder of the TA who got
+        it; delete `ta_assignments_file` before grading starts to recompute
+        it.
+
+        :return: True if the assignment was computed and saved
+        """
+        path = self.ta_assignments_file
+        if os.path.exists(path):
+            return False
+        tas = sorted(self.jsondict["TAs"])
+        self.ta_assignments = rendezvous_map(tas, self.repositories,
+                                             self.submission_weights())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, 'w') as f:
+            json.dump(self.ta_assignments, f, indent=1)
+        os.replace(tmp, path)
+        return True
+
+    def submission_weights(self) -> Dict[str, float]:
+        """Measures each repository's submission in `archive_path` by
+        `ta_weight` (files or lines, not counting excluded files)
+
+        :return: The size of each repository; repositories that have not
+                 been archived yet get the average size
+        """
+        excludes = ExcludeFilter(self.rsync_excludes + [".git"])
+        weights: Dict[str, float] = {}
+        for repo in self.repositories:
+            rpath = self.pull_path(self.archive_path, repo, True, False)
+            if not os.path.isdir(rpath):
+                continue
+            size = 0
+            for _, path, _ in walk_files(rpath, excludes):
+                if self.ta_weight == "files":
+                    size += 1
+                    continue
+                with open(path, 'rb') as f:
+                    size += sum(chunk.count(b"\n")
+                                for chunk in iter(lambda: f.read(1 << 16),
+                                                  b""))
+            weights[repo] = size
+        average = sum(weights.values()) / len(weights) if weights else 1
+        # empty submissions still take some time to grade
+        return {repo: max(weights.get(repo, average), 1)
+                for repo in self.repositories}
+
     @property
     def list_of_users(self) -> List[str]:
         """Returns a list of all users in the course
@@ -191,6 +444,30 @@ class Config(object):
             # no, so add repo and new group from user
             self.repo2group[repo] = [user]
 
+            # index the anonymized name both ways
+            sha1 = hashlib.sha1(repo.encode('utf-8')).hexdigest()
+            self.repo2sha1[repo] = sha1
+            self.sha12repo[sha1] = repo
+
+    def is_checked_out(self, path: str) -> bool:
+        """Checks whether a file is in the working tree of submission clones,
+        given `sparse_paths` (cone mode: files at the top level, files in
+        the parents of a sparse path, and everything below a sparse path)
+
+        :param path: Path of the file, relative to the repository root
+        :rtype: bool
+        :return: True if the file is checked out
+        """
+        if not self.sparse_paths:
+            return True
+        folder = os.path.dirname(path.replace(os.sep, "/"))
+        for sparse in self.sparse_paths:
+            sparse = sparse.strip("/")
+            if folder == sparse or folder.startswith(sparse + "/") or \
+                    folder == "" or sparse.startswith(folder + "/"):
+                return True
+        return False
+
     def lookupGroup(self, repo: str) -> List[str]:
         """Looks up the student(s) assigned to the repo
 
@@ -270,17 +547,21 @@ class Config(object):
         :param anonymize: Whether reponame is anonymized
         :return: The local path of the specified repository
         """
-        # if anonymize, then get the SHA1 hash of the repo name
+        key = ("pull", basepath, repo, str(use_user_name), str(anonymize))
+        if key in self._paths:
+            return self._paths[key]
 
-        reponame = hashlib.sha1(repo.encode(
-            'utf-8')).hexdigest() if anonymize else repo
+        # if anonymize, then get the SHA1 hash of the repo name
+        reponame = self.anonymize(repo) if anonymize else repo
 
         if use_user_name:
             group = self.lookupGroup(repo)
             gname = canonical_group_name(group)
-            return os.path.join(basepath, gname, reponame)
+            path = os.path.join(basepath, gname, reponame)
         else:
-            return os.path.join(basepath, reponame)
+            path = os.path.join(basepath, reponame)
+        self._paths[key] = path
+        return path
 
     def TA_target(self, ta_home: str, ta_dirname: str, repo: str) -> str:
         """Finds out the anonymized local TA path of a repo.
@@ -292,22 +573,42 @@ class Config(object):
         :param repo: Name of the repository
         :return: The anonymized local TA path of a repo
         """
-        return os.path.join(ta_home, ta_dirname, self.lookupTA(repo),
-                            hashlib.sha1(repo.encode('utf-8')).hexdigest())
+        key = ("ta", ta_home, ta_dirname, repo)
+        if key not in self._paths:
+            self._paths[key] = os.path.join(ta_home, ta_dirname,
+                                            self.lookupTA(repo),
+                                            self.anonymize(repo))
+        return self._paths[key]
+
+    def anonymize(self, repo: str) -> str:
+        """Returns the anonymized (SHA1) name of a repository
+
+        :param repo: Name of the repository
+        :return: The anonymized name of the repository
+        """
+        if repo in self.repo2sha1:
+            return self.repo2sha1[repo]
+        return hashlib.sha1(repo.encode('utf-8')).hexdigest()
 
     def deanonymize_sha1_repo(self, anonrepo: str) -> str:
         """Returns the deanonymized name of a repository
 
-        yeah, we brute force these...
-        fortunately, there aren't many to check
-
         :param anonrepo: The anonymized SHA1 name of the repo
         :return: the deanonymized name of a repository
         """
-        for repo in self.repo2group.keys():
-            utf8_repo = repo.encode('utf-8')
-            repohash = hashlib.sha1(utf8_repo).hexdigest()
-            if anonrepo == repohash:
-                return repo
+        if anonrepo in self.sha12repo:
+            return self.sha12repo[anonrepo]
         print("ERROR: Could not deanonymize repository with SHA1 = " + anonrepo)
         sys.exit(1)
+
+    def resolve_repo(self, folder: str) -> str:
+        """Returns the repository name for a folder under `submission_path`,
+        which is named after the SHA1 of the repository if
+        `anonymize_sub_path` is set
+
+        :param folder: Path or name of the folder
+        :return: The name of the repository
+        """
+        name = os.path.basename(os.path.normpath(folder))
+        return self.deanonymize_sha1_repo(name) \
+            if self.anonymize_sub_path else name
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from collections import Counter
 from typing import Set, List
 
 if __name__ == "__main__":
@@ -26,7 +27,7 @@ if __name__ == "__main__":
             names.extend(line.strip().split(","))
     names = [name.casefold() for name in names]
     unique: Set[str] = set(names)
-    duplicates = [name.casefold() for name in names if names.count(name) > 1]
+    duplicates = [name for name, n in Counter(names).items() if n > 1]
     print(f"There are {len(unique)} unique student names in {args.test_list}:")
     print(names)
     print("missing students: ")
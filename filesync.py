@@ -0,0 +1,455 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+Manifest = Dict[str, Tuple[int, int, str]]
+"Map from relative file path to (size, mtime in ns, SHA1 of contents)"
+
+# ioctl request number for FICLONE (reflink a whole file) on Linux
+FICLONE = 0x40049409
+
+
+class SyncFailed(Exception):
+    """Raised when some files could not be synced (like rsync's exit 23)"""
+    pass
+
+
+class SyncStats(object):
+    """Counters describing a single call to `sync_tree`"""
+
+    def __init__(self) -> None:
+        self.copied: int = 0
+        "Number of files, links and special files written"
+
+        self.skipped: int = 0
+        "Number of files that were already up to date"
+
+        self.errors: List[str] = []
+        "Description of every entry that could not be synced"
+
+
+class ExcludeFilter(object):
+    """A set of rsync-style exclude patterns, compiled once
+
+    Patterns follow rsync's rules: a leading `/` anchors the pattern at the
+    root of the transfer, a trailing `/` matches only directories, a pattern
+    without a `/` matches the final path component at any depth, and `*`,
+    `**`, `?` and `[...]` are wildcards (`*` and `?` do not match `/`).
+    """
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns: List[str] = list(patterns)
+        "The original patterns, e.g., for passing on to rsync"
+
+        any_type: List[str] = []
+        dirs_only: List[str] = []
+        for pattern in self.patterns:
+            if not pattern:
+                continue
+            target = any_type
+            if pattern.endswith("/"):
+                pattern = pattern.rstrip("/")
+                target = dirs_only
+            if pattern.startswith("/"):
+                target.append("^" + _translate(pattern.lstrip("/")) + "$")
+            else:
+                target.append("(?:^|/)" + _translate(pattern) + "$")
+
+        self._any: Optional[re.Pattern] = \
+            re.compile("|".join(any_type)) if any_type else None
+        self._dirs: Optional[re.Pattern] = \
+            re.compile("|".join(any_type + dirs_only)) \
+            if any_type or dirs_only else None
+
+    def excluded(self, relpath: str, is_dir: bool) -> bool:
+        """Checks whether a path should be left out of the transfer
+
+        :param relpath: Path relative to the transfer root, `/`-separated
+        :param is_dir: Whether the path is a directory
+        :return: True if the path matches an exclude pattern
+        """
+        regex = self._dirs if is_dir else self._any
+        return regex is not None and regex.search(relpath) is not None
+
+    def excluded_path(self, relpath: str) -> bool:
+        """Checks whether a file, or any directory above it, is excluded
+
+        :param relpath: Path of a file relative to the transfer root
+        :return: True if the file would not be reached by a transfer
+        """
+        parts = relpath.split("/")
+        for i in range(1, len(parts)):
+            if self.excluded("/".join(parts[:i]), True):
+                return True
+        return self.excluded(relpath, False)
+
+
+def _translate(pattern: str) -> str:
+    """Translates one rsync wildcard pattern into a regular expression"""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                res.append(".*")
+                i += 2
+                continue
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        elif c == "[":
+            j = pattern.find("]", i + 2 if pattern.startswith("[!", i)
+                             else i + 1)
+            if j < 0:
+                res.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                res.append("[" + body + "]")
+                i = j
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res)
+
+
+def sync_tree(source: str, target: str, excludes: ExcludeFilter,
+              out: Optional[List[str]] = None,
+              update: bool = True) -> SyncStats:
+    """Copies the contents of `source` into `target`
+
+    Behaves like `rsync -urlptoD` with the given excludes: directories are
+    recursed into, symlinks are copied as symlinks, permissions and
+    modification times are preserved, the owner is preserved when running
+    as root, and device/special files are recreated.  A file is skipped when
+    the target has the same size and modification time or, if `update` is
+    set, a newer modification time.  Nothing in `target` is deleted.
+
+    :param source: Directory whose contents are copied
+    :param target: Directory to copy into; created if missing
+    :param excludes: Compiled exclude patterns
+    :param out: Optional buffer; the relative path of every copied entry is
+                appended to it (like `rsync -v`)
+    :param update: Whether to skip files that are newer in the target
+    :return: Counters for the transfer
+    :raises SyncFailed: if any entry could not be copied
+    """
+    stats = SyncStats()
+    os.makedirs(target, exist_ok=True)
+    _sync_dir(source, target, "", excludes, stats, out, update)
+    _copy_attrs(target, os.stat(source))
+    if stats.errors:
+        if out is not None:
+            out.extend(e + "\n" for e in stats.errors)
+        raise SyncFailed(f"{len(stats.errors)} entries in {source} could "
+                         f"not be synced to {target}")
+    return stats
+
+
+def _sync_dir(src: str, dst: str, rel: str, excludes: ExcludeFilter,
+              stats: SyncStats, out: Optional[List[str]],
+              update: bool) -> None:
+    with os.scandir(src) as it:
+        entries = list(it)
+
+    for entry in entries:
+        relpath = rel + entry.name
+        dpath = os.path.join(dst, entry.name)
+        try:
+            st = entry.stat(follow_symlinks=False)
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if excludes.excluded(relpath, is_dir):
+                continue
+            try:
+                dst_st: Optional[os.stat_result] = os.lstat(dpath)
+            except FileNotFoundError:
+                dst_st = None
+
+            if is_dir:
+                if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                    os.unlink(dpath)
+                    dst_st = None
+                if dst_st is None:
+                    os.mkdir(dpath)
+                    if out is not None:
+                        out.append(relpath + "/\n")
+                _sync_dir(entry.path, dpath, relpath + "/", excludes, stats,
+                          out, update)
+                # set times last so that copying contents does not bump them
+                _copy_attrs(dpath, st)
+                continue
+
+            if dst_st is not None:
+                if stat.S_ISDIR(dst_st.st_mode):
+                    raise IsADirectoryError(
+                        errno.EISDIR, "cannot replace directory", dpath)
+                if update and int(dst_st.st_mtime) > int(st.st_mtime):
+                    stats.skipped += 1
+                    continue
+                if stat.S_IFMT(dst_st.st_mode) == stat.S_IFMT(st.st_mode) \
+                        and dst_st.st_size == st.st_size \
+                        and int(dst_st.st_mtime) == int(st.st_mtime):
+                    stats.skipped += 1
+                    continue
+
+            if stat.S_ISREG(st.st_mode):
+                copy_file(entry.path, dpath, st)
+            elif stat.S_ISLNK(st.st_mode):
+                _replace_symlink(os.readlink(entry.path), dpath, st)
+            else:
+                _replace_special(dpath, st)
+            stats.copied += 1
+            if out is not None:
+                out.append(relpath + "\n")
+        except OSError as e:
+            stats.errors.append(f"{relpath}: {e}")
+
+
+def copy_file(src: str, dst: str,
+              st: Optional[os.stat_result] = None) -> None:
+    """Copies one regular file, preserving permissions and times
+
+    The data is reflinked when the filesystem supports it, otherwise copied
+    in the kernel with `copy_file_range`, otherwise copied through user
+    space.  The new file is written next to `dst` and renamed into place.
+
+    :param src: Source file
+    :param dst: Destination file; replaced if it exists
+    :param st: `os.lstat` of the source, if already known
+    """
+    if st is None:
+        st = os.lstat(src)
+    tmp = os.path.join(os.path.dirname(dst),
+                       "." + os.path.basename(dst) + ".infrasync")
+    try:
+        with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+            _copy_data(fin.fileno(), fout.fileno(), st.st_size)
+            if fout.tell() == 0 and st.st_size > 0:
+                # fell back to user space before any kernel copy happened
+                shutil.copyfileobj(fin, fout, 1 << 20)
+        _copy_attrs(tmp, st)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _copy_data(fdin: int, fdout: int, size: int) -> None:
+    try:
+        fcntl.ioctl(fdout, FICLONE, fdin)
+        os.lseek(fdout, 0, os.SEEK_END)
+        return
+    except OSError:
+        pass
+
+    if not hasattr(os, "copy_file_range"):
+        return
+    remaining = size
+    try:
+        while remaining > 0:
+            n = os.copy_file_range(fdin, fdout, min(remaining, 1 << 30))
+            if n == 0:
+                break
+            remaining -= n
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.EBADF):
+            raise
+        if remaining != size:
+            raise
+
+
+def _replace_symlink(linkto: str, dst: str, st: os.stat_result) -> None:
+    tmp = os.path.join(os.path.dirname(dst),
+                       "." + os.path.basename(dst) + ".infrasync")
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(linkto, tmp)
+    if os.utime in os.supports_follow_symlinks:
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+    if os.geteuid() == 0:
+        os.lchown(tmp, st.st_uid, -1)
+    os.replace(tmp, dst)
+
+
+def _replace_special(dst: str, st: os.stat_result) -> None:
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if stat.S_ISFIFO(st.st_mode):
+        os.mkfifo(dst, stat.S_IMODE(st.st_mode))
+    else:
+        # device nodes and sockets; device nodes need root, like rsync -D
+        os.mknod(dst, st.st_mode, st.st_rdev)
+    _copy_attrs(dst, st)
+
+
+def _copy_attrs(path: str, st: os.stat_result) -> None:
+    # -o: the owner can only be changed by the super-user
+    if os.geteuid() == 0:
+        os.chown(path, st.st_uid, -1)
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def rsync_command(source: str, target: str, excludes: ExcludeFilter,
+                  verbose: bool) -> List[str]:
+    """Builds the equivalent `rsync` command for `sync_tree`
+
+    :param source: Directory whose contents are copied
+    :param target: Directory to copy into
+    :param excludes: Compiled exclude patterns
+    :param verbose: Whether rsync should list transferred files
+    :return: The rsync command line
+    """
+    # trailing slash makes rsync copy the _contents_ of source into target
+    cmd = ["rsync", "-vurlptoD" if verbose else "-urlptoD"]
+    cmd.extend([f"--exclude={e}" for e in excludes.patterns])
+    cmd.extend([source.rstrip("/") + "/", target])
+    return cmd
+
+
+def file_sha1(path: str) -> str:
+    """Returns the hex SHA1 digest of a file's contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def walk_files(root: str, excludes: ExcludeFilter, rel: str = ""
+               ) -> Iterator[Tuple[str, str, os.stat_result]]:
+    """Yields `(relpath, path, stat)` for every regular file under `root`
+    that is not excluded, without following symlinks
+
+    :param root: Directory to walk
+    :param excludes: Compiled exclude patterns
+    :param rel: Relative path of `root` within the walk (used internally)
+    """
+    with os.scandir(root) as it:
+        entries = list(it)
+    for entry in entries:
+        relpath = rel + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            if not excludes.excluded(relpath, True):
+                yield from walk_files(entry.path, excludes, relpath + "/")
+        elif entry.is_file(follow_symlinks=False):
+            if not excludes.excluded(relpath, False):
+                yield relpath, entry.path, entry.stat(follow_symlinks=False)
+
+
+def build_manifest(root: str, excludes: ExcludeFilter,
+                   previous: Optional[Manifest] = None) -> Manifest:
+    """Describes every file under `root` by size, mtime and content hash
+
+    Files whose size and mtime match their entry in `previous` are not
+    read again.
+
+    :param root: Directory to describe
+    :param excludes: Compiled exclude patterns
+    :param previous: An earlier manifest of the same directory, if any
+    :return: The manifest
+    """
+    previous = previous or {}
+    manifest: Manifest = {}
+    for relpath, path, st in walk_files(root, excludes):
+        old = previous.get(relpath)
+        if old is not None and old[0] == st.st_size \
+                and old[1] == st.st_mtime_ns:
+            manifest[relpath] = old
+        else:
+            manifest[relpath] = (st.st_size, st.st_mtime_ns, file_sha1(path))
+    return manifest
+
+
+def manifest_digest(manifest: Manifest) -> str:
+    """Returns a hex SHA1 digest of the paths and contents a manifest
+    describes; sizes and mtimes do not affect it
+
+    :param manifest: A manifest from `build_manifest`
+    :return: The digest
+    """
+    h = hashlib.sha1()
+    for relpath in sorted(manifest):
+        h.update(f"{relpath}\0{manifest[relpath][2]}\n".encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_manifest(path: str) -> Optional[Manifest]:
+    """Reads a manifest written by `save_manifest`, or None if missing"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return {k: (v[0], v[1], v[2]) for k, v in json.load(f).items()}
+
+
+def save_manifest(path: str, manifest: Manifest) -> None:
+    """Atomically writes a manifest to `path`"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, separators=(",", ":"), sort_keys=True)
+    os.replace(tmp, path)
+
+
+def sync_changes(source: str, target: str, excludes: ExcludeFilter,
+                 manifest: Manifest,
+                 out: Optional[List[str]] = None) -> int:
+    """Copies only the files in `source` that differ from `manifest`
+
+    `manifest` describes `source` as it was handed out.  Files that were
+    added or changed since then are copied into `target`, and files that
+    were deleted are removed from `target`.  As with `sync_tree`, a changed
+    file is not copied over a newer file in `target`.
+
+    :param source: Directory that may have been edited
+    :param target: Directory to apply the edits to
+    :param excludes: Compiled exclude patterns
+    :param manifest: Manifest of `source` when it was handed out
+    :param out: Optional buffer; every changed path is appended to it
+    :return: The number of files added, changed or deleted
+    """
+    changes = 0
+    seen = set()
+    for relpath, path, st in walk_files(source, excludes):
+        seen.add(relpath)
+        old = manifest.get(relpath)
+        if old is not None and (
+                (old[0] == st.st_size and old[1] == st.st_mtime_ns) or
+                (old[0] == st.st_size and old[2] == file_sha1(path))):
+            continue
+        dst = os.path.join(target, relpath)
+        try:
+            if int(os.lstat(dst).st_mtime) > int(st.st_mtime):
+                continue
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        copy_file(path, dst, st)
+        changes += 1
+        if out is not None:
+            out.append(relpath + "\n")
+
+    for relpath in manifest.keys() - seen:
+        if excludes.excluded_path(relpath):
+            # not deleted, just not visible with these excludes
+            continue
+        dst = os.path.join(target, relpath)
+        if os.path.lexists(dst) and not os.path.isdir(dst):
+            os.unlink(dst)
+            changes += 1
+            if out is not None:
+                out.append("deleting " + relpath + "\n")
+    return changes
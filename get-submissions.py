@@ -2,27 +2,65 @@
 
 from subprocess import call
 
+import argparse
+
 from Infrastructor import Infrastructor
 from config import Config
 from utils import self_check
 
 
 def main() -> None:
-    args = Infrastructor.default_parser.parse_args()
+    parser = argparse.ArgumentParser(parents=[Infrastructor.default_parser],
+                                     add_help=False)
+    parser.add_argument('-l', '--from-archive', action='store_true',
+                        help='fill the submission folder from the archive '
+                             'clones instead of cloning from GitHub again')
+    parser.add_argument('-u', '--skip-unchanged', action='store_true',
+                        help='look up remote heads first and skip '
+                             'repositories that have not changed since the '
+                             'last run')
+    args = parser.parse_args()
 
     # get config
     self_check()
     conf = Config(args.config, args.verbose)
     conf.pretty_print()
 
+    # find out which repositories changed since the last run
+    heads = Infrastructor.remote_heads(conf, args.jobs) \
+        if args.skip_unchanged else None
+
     # clone/update archive
-    Infrastructor.pull_all(conf, conf.archive_path, True, False)
-    Infrastructor.pull_all(conf, conf.submission_path, False,
-                           conf.anonymize_sub_path)
+    # archive clones never depend on the shared starter objects
+    failed = Infrastructor.pull_all(conf, conf.archive_path, True, False,
+                                    args.jobs, heads, dissociate=True)
+    # balance TAs by the size of what was actually submitted, once; later
+    # runs keep every repository with the TA who already has it
+    if conf.ta_weight != "none" and conf.weigh_tas():
+        print(f"Saved weighted TA assignment to {conf.ta_assignments_file}")
+
+    if args.from_archive:
+        # repositories whose archive clone failed to update are not
+        # considered synced in the submission folder
+        if heads is not None:
+            heads = {r: h for r, h in heads.items() if r not in failed}
+        failed = Infrastructor.pull_all_from_archive(
+            conf, conf.archive_path, conf.submission_path, False,
+            conf.anonymize_sub_path, args.jobs, heads, partial=True)
+    else:
+        # honor clone_filter and sparse_paths; the archive stays complete
+        failed = Infrastructor.pull_all(conf, conf.submission_path, False,
+                                        conf.anonymize_sub_path, args.jobs,
+                                        heads, partial=True)
+
+    # a repository whose submission clone failed to update is copied again
+    # next time instead of being recorded as synced at its new head
+    if heads is not None:
+        heads = {r: h for r, h in heads.items() if r not in failed}
 
     # copy to TA folders
     Infrastructor.copy_to_ta_folders(conf, conf.ta_path, conf.assignment_name,
-                                     conf.submission_path)
+                                     conf.submission_path, heads, args.jobs)
 
     ## set group permissions in submissions directory ... ##
     call(["chmod", "-R", "2770", conf.submission_path])
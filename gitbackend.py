@@ -0,0 +1,252 @@
+import os
+import subprocess
+import sys
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+from utils import run_logged
+
+
+class GitBackend(ABC):
+    """The git operations Infrastructor performs on local repositories
+
+    Operations that talk to GitHub (clone, pull, push) always use the `git`
+    command; a backend decides how the small local queries and updates are
+    done.  All backends must leave a repository in the same state.
+    """
+
+    @abstractmethod
+    def branch_exists(self, rdir: str, branch: str) -> bool:
+        """Checks if a local branch exists
+
+        :param rdir: Path to a local repository
+        :param branch: Name of the branch
+        :return: If the branch exists
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rev_before(self, rdir: str, branch: str, timestamp: int) -> str:
+        """Finds the last commit on a branch made no later than `timestamp`,
+        like `git rev-list -1 --before=<timestamp> <branch>`
+
+        :param rdir: Path to a local repository
+        :param branch: Name of the branch
+        :param timestamp: A UNIX timestamp
+        :return: The SHA of the commit, or "" if there is none
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def checkout(self, rdir: str, ref: str, out: List[str]) -> None:
+        """Checks out a branch or commit, like `git checkout <ref>`
+
+        :param rdir: Path to a local repository
+        :param ref: Branch name or commit SHA
+        :param out: Output buffer for this repository
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_branch(self, rdir: str, branch: str, out: List[str]) -> None:
+        """Creates a branch at HEAD and switches to it, like
+        `git checkout -b <branch>`
+
+        :param rdir: Path to a local repository
+        :param branch: Name of the new branch
+        :param out: Output buffer for this repository
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_blob(self, rdir: str, branch: str, path: str
+                  ) -> Optional[bytes]:
+        """Reads a file as of the tip of a branch, without checking it out,
+        like `git cat-file blob <branch>:<path>`
+
+        :param rdir: Path to a local repository
+        :param branch: Name of the branch
+        :param path: Path of the file within the repository
+        :return: The contents of the file, or None if the branch or the file
+                 does not exist
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def commit_all(self, rdir: str, message: str, out: List[str]) -> bool:
+        """Stages every added, modified and deleted file that is not ignored
+        and commits, like `git add '*' && git commit -am <message>`
+
+        :param rdir: Path to a local repository
+        :param message: The commit message
+        :param out: Output buffer for this repository
+        :return: True if a commit was made, False if there was nothing to
+                 commit
+        """
+        raise NotImplementedError
+
+
+class SubprocessGitBackend(GitBackend):
+    """Runs every operation as a `git` subprocess"""
+
+    def branch_exists(self, rdir: str, branch: str) -> bool:
+        proc = subprocess.run(["git", "show-ref", "--verify", "--quiet",
+                               "refs/heads/" + branch],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              cwd=rdir)
+        return proc.returncode == 0
+
+    def rev_before(self, rdir: str, branch: str, timestamp: int) -> str:
+        proc = subprocess.run(["git", "rev-list", "-1",
+                               "--before=\"" + str(timestamp) + "\"",
+                               branch],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True,
+                              cwd=rdir)
+        return proc.stdout.rstrip()
+
+    def checkout(self, rdir: str, ref: str, out: List[str]) -> None:
+        run_logged(["git", "checkout", ref], out, cwd=rdir)
+
+    def read_blob(self, rdir: str, branch: str, path: str
+                  ) -> Optional[bytes]:
+        # one process per call; every repository has its own object
+        # database, so a shared `cat-file --batch` could not serve them
+        proc = subprocess.run(["git", "cat-file", "blob",
+                               f"refs/heads/{branch}:{path}"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              cwd=rdir)
+        return proc.stdout if proc.returncode == 0 else None
+
+    def create_branch(self, rdir: str, branch: str, out: List[str]) -> None:
+        run_logged(["git", "checkout", "-b", branch], out, cwd=rdir)
+
+    def commit_all(self, rdir: str, message: str, out: List[str]) -> bool:
+        # add any new files
+        run_logged(["git", "add", "*"], out, cwd=rdir, check=False)
+        proc = run_logged(["git", "commit", "-am", message], out, cwd=rdir,
+                          check=False)
+        return proc.returncode == 0
+
+
+class DulwichGitBackend(SubprocessGitBackend):
+    """Answers ref lookups, rev-list cutoffs, index updates and commits
+    in-process with dulwich; everything else uses `git`
+
+    Requires the optional `dulwich` package.
+    """
+
+    def __init__(self) -> None:
+        try:
+            import dulwich.index
+            import dulwich.porcelain
+            import dulwich.repo
+        except ImportError:
+            print("ERROR: \"git_backend\": \"dulwich\" requires the dulwich "
+                  "package (pip install dulwich).", file=sys.stderr)
+            sys.exit(1)
+        self._index = dulwich.index
+        self._porcelain = dulwich.porcelain
+        self._Repo = dulwich.repo.Repo
+
+    def branch_exists(self, rdir: str, branch: str) -> bool:
+        with self._Repo(rdir) as r:
+            return b"refs/heads/" + branch.encode('utf-8') in r.refs
+
+    def rev_before(self, rdir: str, branch: str, timestamp: int) -> str:
+        with self._Repo(rdir) as r:
+            ref = b"refs/heads/" + branch.encode('utf-8')
+            if ref not in r.refs:
+                return ""
+            for entry in r.get_walker(include=[r.refs[ref]],
+                                      until=int(timestamp)):
+                return entry.commit.id.decode('ascii')
+        return ""
+
+    def read_blob(self, rdir: str, branch: str, path: str
+                  ) -> Optional[bytes]:
+        with self._Repo(rdir) as r:
+            ref = b"refs/heads/" + branch.encode('utf-8')
+            if ref not in r.refs:
+                return None
+            tree = r[r[r.refs[ref]].tree]
+            try:
+                _, sha = tree.lookup_path(r.object_store.__getitem__,
+                                          path.encode('utf-8'))
+                return r[sha].data
+            except (KeyError, AttributeError):
+                # missing, or a directory/submodule rather than a file
+                return None
+
+    def create_branch(self, rdir: str, branch: str, out: List[str]) -> None:
+        with self._Repo(rdir) as r:
+            ref = b"refs/heads/" + branch.encode('utf-8')
+            if ref in r.refs:
+                raise ValueError(f"branch '{branch}' already exists")
+            r.refs[ref] = r.head()
+            r.refs.set_symbolic_ref(b"HEAD", ref)
+        out.append(f"Switched to a new branch '{branch}'\n")
+
+    def commit_all(self, rdir: str, message: str, out: List[str]) -> bool:
+        with self._Repo(rdir) as r:
+            status = self._porcelain.status(r, untracked_files="all")
+            # unstaged holds modified and deleted files; staging a missing
+            # file removes it from the index
+            paths = {os.fsdecode(p) for p in status.unstaged}
+            paths.update(os.fsdecode(p) for p in status.untracked)
+            paths.update(self._mode_changes(r))
+            if paths:
+                r.stage(sorted(paths))
+
+            head_tree = r[r.head()].tree
+            if r.open_index().commit(r.object_store) == head_tree:
+                out.append("nothing to commit, working tree clean\n")
+                return False
+
+            # `git commit -m` always ends the message with a newline
+            commit = r.do_commit(message.rstrip("\n").encode('utf-8') + b"\n")
+            out.append(f"[{commit.decode('ascii')[:7]}] {message}\n")
+            return True
+
+    def _mode_changes(self, r: Any) -> List[str]:
+        # status() reports content changes only; `git commit -a` also
+        # records a file that was only made (non-)executable
+        if not r.get_config().get_boolean(b"core", b"filemode", True):
+            return []
+        changed = []
+        for path, entry in r.open_index().items():
+            mode = getattr(entry, "mode", None)
+            if mode is None or self._index.S_ISGITLINK(mode):
+                # a conflict or a submodule
+                continue
+            try:
+                st = os.lstat(os.path.join(r.path, os.fsdecode(path)))
+            except FileNotFoundError:
+                # deletions are already in status().unstaged
+                continue
+            if self._index.cleanup_mode(st.st_mode) != mode:
+                changed.append(os.fsdecode(path))
+        return changed
+
+
+BACKENDS = {
+    "subprocess": SubprocessGitBackend,
+    "dulwich": DulwichGitBackend,
+}
+"Available git backends, by the name used for `git_backend` in the config"
+
+_instances: Dict[str, GitBackend] = {}
+
+
+def get_backend(name: str) -> GitBackend:
+    """Returns the (shared) git backend with the given name
+
+    :param name: A key of `BACKENDS`
+    :return: The backend
+    """
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
@@ -0,0 +1,551 @@
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Collection, Dict, List, Mapping, \
+    NamedTuple, Optional, Sequence, Set, Tuple, TypeVar
+
+import requests
+
+# Generics for type hints in ApiScheduler
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+DEFAULT_API_URL = "https://api.github.com"
+"Base URL of the GitHub API; point it at a stand-in server for testing"
+
+GRAPHQL_BATCH = 50
+"Number of repositories looked up per aliased GraphQL query"
+
+MUTATION_BATCH = 10
+"Number of pull requests created per aliased GraphQL mutation"
+
+USER_BATCH = 100
+"Number of logins looked up per aliased GraphQL query"
+
+PAGE_SIZE = 100
+"Number of items requested per page of a paginated REST list"
+
+
+class GitHubAPIError(Exception):
+    """Raised when the GitHub API returns an error for a whole request"""
+
+    def __init__(self, message: str, status: Optional[int] = None,
+                 headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        "HTTP status of the failed request, if there was one"
+        self.headers: Mapping[str, str] = headers or {}
+        "HTTP headers of the failed request"
+
+
+class ApiScheduler(object):
+    """Runs GitHub API calls concurrently while staying within GitHub's rate
+    limits
+
+    Every call made through `call` is throttled by what the most recent
+    responses said about the primary rate limit (`X-RateLimit-Remaining`
+    and `X-RateLimit-Reset`).  Calls are spread out over the rest of the
+    window once the remaining quota runs low, and all workers wait for the
+    reset when it runs out.  A secondary rate limit (`Retry-After`) pauses
+    all workers for the requested time.  Server errors and dropped
+    connections are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, jobs: int = 4, github: Any = None, retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0,
+                 low_water: int = 100):
+        """
+        :param jobs: Maximum number of concurrent calls made by `map`
+        :param github: Optional `github.Github` object whose rate limit
+                       bookkeeping is read after every call
+        :param retries: How many times a failing call is retried
+        :param base_delay: First backoff delay, in seconds
+        :param max_delay: Longest backoff delay, in seconds
+        :param low_water: Remaining quota below which calls are paced
+        """
+        self.jobs = max(1, jobs)
+        self.github = github
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self._remaining: Optional[int] = None
+        self._reset: float = 0.0
+        self._pause_until: float = 0.0
+        self._next_slot: float = 0.0
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        """Updates the rate limit bookkeeping from a response's headers
+
+        :param headers: HTTP response headers
+        """
+        # PyGithub lower-cases header names; requests does not
+        headers = {k.lower(): v for k, v in headers.items()}
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if remaining is not None and reset is not None:
+            with self._lock:
+                self._remaining = int(remaining)
+                self._reset = float(reset)
+
+    def _observe_github(self) -> None:
+        if self.github is None:
+            return
+        remaining, _ = self.github.rate_limiting
+        if remaining < 0:
+            return
+        with self._lock:
+            self._remaining = remaining
+            self._reset = float(self.github.rate_limiting_resettime)
+
+    def _pause(self, seconds: float) -> None:
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.time() + seconds)
+
+    def _wait_turn(self) -> None:
+        with self._lock:
+            now = time.time()
+            start = max(now, self._pause_until)
+            if self._remaining is not None and self._reset > now:
+                if self._remaining <= 0:
+                    # out of quota: everybody waits for the reset
+                    start = max(start, self._reset + 1)
+                elif self._remaining < self.low_water:
+                    # spread the rest of the quota over the rest of the window
+                    interval = (self._reset - now) / self._remaining
+                    start = max(start, self._next_slot)
+                    self._next_slot = start + interval
+                    self._remaining -= 1
+        delay = start - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter" exponential backoff
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def call(self, fn: Callable[[], _R],
+             retry_statuses: Collection[int] = ()) -> _R:
+        """Makes one API call, waiting for quota and retrying as needed
+
+        :param fn: A function that makes the call, e.g., a lambda around a
+                   PyGithub method
+        :param retry_statuses: Additional HTTP statuses worth retrying, e.g.,
+                               404 for a repository that was just created
+        :return: What `fn` returns
+        :raises Exception: what `fn` raised, once retries are exhausted or
+                           if the error is not worth retrying
+        """
+        attempt = 0
+        while True:
+            self._wait_turn()
+            try:
+                result = fn()
+                self._observe_github()
+                return result
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                status = getattr(e, "status", None)
+                headers = {k.lower(): v for k, v in
+                           (getattr(e, "headers", None) or {}).items()}
+                self.observe(headers)
+                if status in (403, 429) and (
+                        "retry-after" in headers or
+                        headers.get("x-ratelimit-remaining") == "0" or
+                        "rate limit" in str(e).lower()):
+                    if "retry-after" in headers:
+                        delay = float(headers["retry-after"])
+                    elif headers.get("x-ratelimit-remaining") == "0":
+                        delay = max(0.0, float(headers.get(
+                            "x-ratelimit-reset", 0)) - time.time()) + 1
+                    else:
+                        # secondary limit without a hint: wait at least a
+                        # minute, as GitHub asks
+                        delay = 60 + self._backoff(attempt)
+                    print(f"Rate limited by GitHub; pausing for "
+                          f"{delay:.0f} seconds.")
+                    self._pause(delay)
+                elif status is None and not isinstance(
+                        e, requests.exceptions.RequestException):
+                    raise
+                elif status is not None and status < 500 \
+                        and status not in retry_statuses:
+                    raise
+                else:
+                    time.sleep(self._backoff(attempt))
+                attempt += 1
+
+    def map(self, fn: Callable[[_T], _R], items: Sequence[_T]
+            ) -> Tuple[Dict[_T, _R], Dict[_T, Exception]]:
+        """Runs `fn(item)` for every item using up to `jobs` threads
+
+        `fn` should make its API calls through `call`.
+
+        :param fn: The per-item work
+        :param items: The items
+        :return: A pair of (results, failures), both keyed by item
+        """
+        results: Dict[_T, _R] = {}
+        failures: Dict[_T, Exception] = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {pool.submit(fn, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    failures[item] = e
+        return ({i: results[i] for i in items if i in results},
+                {i: failures[i] for i in items if i in failures})
+
+
+class BranchState(NamedTuple):
+    """What a preflight query found out about one remote repository"""
+    repo_id: str
+    "GraphQL node ID of the repository"
+    has_default: bool
+    "Whether the default branch exists"
+    has_feedback: bool
+    "Whether the feedback branch exists"
+
+
+class GitHubClient(object):
+    """A small GitHub REST/GraphQL client on a pooled `requests.Session`
+
+    PyGithub makes one REST call per question; this client is used where
+    many questions can be batched into a single GraphQL query.
+    """
+
+    def __init__(self, user: str, password: str,
+                 api_url: str = DEFAULT_API_URL,
+                 scheduler: Optional[ApiScheduler] = None):
+        self.api_url: str = api_url.rstrip("/")
+        "Base URL of the API, without a trailing slash"
+
+        self.scheduler: ApiScheduler = scheduler or ApiScheduler()
+        "Throttles and retries every request"
+
+        self.session = requests.Session()
+        "The pooled HTTP session used for all requests"
+        self.session.auth = (user, password)
+        self.session.headers.update({"Accept": "application/vnd.github+json"})
+
+    def request(self, method: str, path: str, **kwargs: Any
+                ) -> requests.Response:
+        """Sends one REST request
+
+        :param method: HTTP method, e.g., "GET"
+        :param path: Path below the API URL, e.g., "/orgs/williams-cs"
+        :param kwargs: Passed on to `requests.Session.request`
+        :return: The response; HTTP errors other than rate limits and server
+                 errors are not raised
+        :raises GitHubAPIError: if the request was still rate limited or
+                                failing with a server error after retries
+        """
+
+        def send() -> requests.Response:
+            r = self.session.request(method, self.api_url + path, **kwargs)
+            self.scheduler.observe(r.headers)
+            if r.status_code >= 500 or r.status_code == 429 or (
+                    r.status_code == 403 and (
+                    "Retry-After" in r.headers or
+                    r.headers.get("X-RateLimit-Remaining") == "0" or
+                    "rate limit" in r.text.lower())):
+                raise GitHubAPIError(f"{method} {path} failed with status "
+                                     f"{r.status_code}: {r.text}",
+                                     r.status_code, r.headers)
+            return r
+
+        return self.scheduler.call(send)
+
+    def graphql(self, query: str, variables: Optional[Dict[str, Any]] = None
+                ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Runs one GraphQL query or mutation
+
+        :param query: The GraphQL document
+        :param variables: Values for the document's variables
+        :return: The `data` object and the list of (partial) `errors`
+        :raises GitHubAPIError: if the request failed as a whole
+        """
+        r = self.request("POST", "/graphql",
+                         json={"query": query, "variables": variables or {}})
+        if r.status_code != 200:
+            raise GitHubAPIError(f"GraphQL request failed with status "
+                                 f"{r.status_code}: {r.text}",
+                                 r.status_code, r.headers)
+        body = r.json()
+        errors = body.get("errors") or []
+        if body.get("data") is None:
+            raise GitHubAPIError(f"GraphQL request failed: {errors}")
+        return body["data"], errors
+
+    def get_all(self, path: str) -> List[Dict[str, Any]]:
+        """Fetches every page of a paginated REST list
+
+        :param path: Path below the API URL, e.g., "/orgs/williams-cs/members"
+        :return: The items of all pages
+        :raises GitHubAPIError: if a page could not be fetched
+        """
+        items: List[Dict[str, Any]] = []
+        url: Optional[str] = path + ("&" if "?" in path else "?") + \
+            f"per_page={PAGE_SIZE}"
+        while url is not None:
+            r = self.request("GET", url)
+            if r.status_code != 200:
+                raise GitHubAPIError(f"GET {url} failed with status "
+                                     f"{r.status_code}: {r.text}",
+                                     r.status_code, r.headers)
+            items.extend(r.json())
+            url = r.links.get("next", {}).get("url")
+            if url is not None and url.startswith(self.api_url):
+                url = url[len(self.api_url):]
+        return items
+
+
+def _batches(items: Sequence[str], size: int) -> List[Sequence[str]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _errors_by_alias(errors: List[Dict[str, Any]]) -> Dict[str, str]:
+    by_alias: Dict[str, str] = {}
+    for e in errors:
+        path = e.get("path") or []
+        if path:
+            by_alias[str(path[0])] = e.get("message", "unknown error")
+    return by_alias
+
+
+def branch_states(client: GitHubClient, owner: str, repos: Sequence[str],
+                  default_branch: str, feedback_branch: str
+                  ) -> Dict[str, BranchState]:
+    """Looks up the default and feedback branches of many repositories in a
+    few aliased GraphQL queries
+
+    :param client: The API client
+    :param owner: The GitHub organization
+    :param repos: Names of the repositories
+    :param default_branch: Name of the default branch
+    :param feedback_branch: Name of the feedback branch
+    :return: A map from repository to its branch state; repositories that
+             do not exist (or are not visible) are left out
+    """
+    states: Dict[str, BranchState] = {}
+    for batch in _batches(repos, GRAPHQL_BATCH):
+        params = ["$owner: String!", "$default: String!",
+                  "$feedback: String!"]
+        fields = []
+        variables: Dict[str, Any] = {
+            "owner": owner,
+            "default": "refs/heads/" + default_branch,
+            "feedback": "refs/heads/" + feedback_branch,
+        }
+        for i, repo in enumerate(batch):
+            params.append(f"$n{i}: String!")
+            variables[f"n{i}"] = repo
+            fields.append(f"r{i}: repository(owner: $owner, name: $n{i}) "
+                          f"{{ ...branches }}")
+        query = (f"query({', '.join(params)}) {{ {' '.join(fields)} }} "
+                 f"fragment branches on Repository {{ id "
+                 f"d: ref(qualifiedName: $default) {{ id }} "
+                 f"f: ref(qualifiedName: $feedback) {{ id }} }}")
+        data, _ = client.graphql(query, variables)
+        for i, repo in enumerate(batch):
+            node = data.get(f"r{i}")
+            if node is not None:
+                states[repo] = BranchState(node["id"], node["d"] is not None,
+                                           node["f"] is not None)
+    return states
+
+
+def repo_sizes(client: GitHubClient, owner: str, repos: Sequence[str]
+               ) -> Dict[str, int]:
+    """Looks up the size of many repositories in a few aliased GraphQL
+    queries, without cloning them
+
+    :param client: The API client
+    :param owner: The GitHub organization
+    :param repos: Names of the repositories
+    :return: A map from repository to its size on GitHub in kilobytes;
+             repositories that do not exist (or are not visible) are left out
+    """
+    sizes: Dict[str, int] = {}
+    for batch in _batches(repos, GRAPHQL_BATCH):
+        params = ["$owner: String!"]
+        fields = []
+        variables: Dict[str, Any] = {"owner": owner}
+        for i, repo in enumerate(batch):
+            params.append(f"$n{i}: String!")
+            variables[f"n{i}"] = repo
+            fields.append(f"r{i}: repository(owner: $owner, name: $n{i}) "
+                          f"{{ diskUsage }}")
+        query = f"query({', '.join(params)}) {{ {' '.join(fields)} }}"
+        data, _ = client.graphql(query, variables)
+        for i, repo in enumerate(batch):
+            node = data.get(f"r{i}")
+            if node is not None:
+                sizes[repo] = node["diskUsage"] or 0
+    return sizes
+
+
+def resolve_users(client: GitHubClient, logins: Sequence[str]
+                  ) -> Dict[str, Optional[str]]:
+    """Looks up many GitHub accounts in a few aliased GraphQL queries
+
+    :param client: The API client
+    :param logins: The logins to look up
+    :return: A map from each login to the account's canonical login (GitHub
+             logins are case-insensitive), or to None if there is no such
+             account
+    """
+    users: Dict[str, Optional[str]] = {}
+    for batch in _batches(logins, USER_BATCH):
+        params = []
+        fields = []
+        variables: Dict[str, Any] = {}
+        for i, login in enumerate(batch):
+            params.append(f"$l{i}: String!")
+            variables[f"l{i}"] = login
+            fields.append(f"u{i}: user(login: $l{i}) {{ login }}")
+        query = f"query({', '.join(params)}) {{ {' '.join(fields)} }}"
+        # unknown users are reported as partial errors
+        data, _ = client.graphql(query, variables)
+        for i, login in enumerate(batch):
+            node = data.get(f"u{i}")
+            users[login] = node["login"] if node is not None else None
+    return users
+
+
+class OrgMembership(NamedTuple):
+    """The members and pending invitations of an organization, by lowercase
+    login"""
+    members: Set[str]
+    "Logins of the organization's members"
+    invited: Set[str]
+    "Logins with a pending invitation to the organization"
+
+
+def org_membership(client: GitHubClient, org: str) -> OrgMembership:
+    """Fetches the members and pending invitations of an organization once,
+    so that roster checks can be answered locally
+
+    :param client: The API client
+    :param org: The GitHub organization
+    :return: The organization's membership
+    """
+    members = {m["login"].lower()
+               for m in client.get_all(f"/orgs/{org}/members")}
+    # invitations sent by email have no login
+    try:
+        invited = {i["login"].lower()
+                   for i in client.get_all(f"/orgs/{org}/invitations")
+                   if i.get("login")}
+    except GitHubAPIError as e:
+        # listing invitations requires an organization owner's token
+        if e.status not in (403, 404):
+            raise
+        print(f"WARNING: could not list the invitations of {org} ({e}); "
+              f"checking members only.", file=sys.stderr)
+        invited = set()
+    return OrgMembership(members, invited)
+
+
+def create_pull_requests(client: GitHubClient,
+                         requests_by_repo: Dict[str, Dict[str, str]]
+                         ) -> Dict[str, str]:
+    """Creates many pull requests using aliased GraphQL mutations
+
+    :param client: The API client
+    :param requests_by_repo: A map from repository to a
+                             `CreatePullRequestInput` (repositoryId,
+                             baseRefName, headRefName, title, body)
+    :return: A map from repository to the URL of its new pull request, or to
+             an error message starting with "ERROR:"
+    """
+    results: Dict[str, str] = {}
+    for batch in _batches(list(requests_by_repo.keys()), MUTATION_BATCH):
+        params = []
+        fields = []
+        variables: Dict[str, Any] = {}
+        for i, repo in enumerate(batch):
+            params.append(f"$i{i}: CreatePullRequestInput!")
+            variables[f"i{i}"] = requests_by_repo[repo]
+            fields.append(f"p{i}: createPullRequest(input: $i{i}) "
+                          f"{{ pullRequest {{ url }} }}")
+        query = f"mutation({', '.join(params)}) {{ {' '.join(fields)} }}"
+        try:
+            data, errors = client.graphql(query, variables)
+        except GitHubAPIError as e:
+            for repo in batch:
+                results[repo] = f"ERROR: {e}"
+            continue
+        failed = _errors_by_alias(errors)
+        for i, repo in enumerate(batch):
+            node = data.get(f"p{i}")
+            if node is not None and node.get("pullRequest"):
+                results[repo] = node["pullRequest"]["url"]
+            else:
+                results[repo] = "ERROR: " + failed.get(f"p{i}",
+                                                       "no pull request")
+    return results
+
+
+def ensure_template_repo(client: GitHubClient, owner: str, name: str,
+                         description: str) -> bool:
+    """Makes sure a private template repository exists
+
+    :param client: The API client
+    :param owner: The organization that owns the template
+    :param name: The name of the template repository
+    :param description: The description given to a newly created template
+    :return: True if the repository was created
+    :raises GitHubAPIError: if the repository could not be read, created or
+                            marked as a template
+    """
+    r = client.request("GET", f"/repos/{owner}/{name}")
+    if r.status_code == 404:
+        r = client.request("POST", f"/orgs/{owner}/repos",
+                           json={"name": name, "description": description,
+                                 "private": True, "is_template": True,
+                                 "auto_init": False})
+        if r.status_code != 201:
+            raise GitHubAPIError(f"could not create template {owner}/{name}: "
+                                 f"{r.text}", r.status_code, r.headers)
+        return True
+    if r.status_code != 200:
+        raise GitHubAPIError(f"could not read template {owner}/{name}: "
+                             f"{r.text}", r.status_code, r.headers)
+    if not r.json().get("is_template"):
+        r = client.request("PATCH", f"/repos/{owner}/{name}",
+                           json={"is_template": True})
+        if r.status_code != 200:
+            raise GitHubAPIError(f"could not mark {owner}/{name} as a "
+                                 f"template: {r.text}", r.status_code,
+                                 r.headers)
+    return False
+
+
+def generate_from_template(client: GitHubClient, template: str, owner: str,
+                           name: str, description: str) -> None:
+    """Creates a private repository from a template repository; GitHub copies
+    the template's default branch on the server
+
+    :param client: The API client
+    :param template: The template, as "owner/name"
+    :param owner: The organization that owns the new repository
+    :param name: The name of the new repository
+    :param description: The description of the new repository
+    :raises GitHubAPIError: if the repository could not be created
+    """
+    r = client.request("POST", f"/repos/{template}/generate",
+                       json={"owner": owner, "name": name,
+                             "description": description, "private": True,
+                             "include_all_branches": False})
+    if r.status_code != 201:
+        raise GitHubAPIError(f"could not generate {owner}/{name} from "
+                             f"{template}: {r.text}", r.status_code,
+                             r.headers)
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
+import hashlib
+import os.path
+import sys
 from urllib.parse import urljoin
 
 import argparse
 from requests.auth import HTTPBasicAuth
 
 from Infrastructor import Infrastructor
-from config import Config
+from config import Config, cache_dir
 from utils import self_check
 
 
@@ -33,6 +36,18 @@ def main() -> None:
 
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only send configs that changed since they '
+                             'were last sent to this server')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip the request bodies; only for servers '
+                             'that accept gzip-encoded requests')
+    parser.add_argument('--batch-size', type=int, default=20,
+                        help='number of configs sent per request '
+                             '(default: 20)')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='number of times a failed request is retried '
+                             '(default: 5)')
 
     args = parser.parse_args()
 
@@ -41,7 +56,15 @@ def main() -> None:
 
     full_api_uri: str = urljoin(args.attempt_server, args.api_uri)
     auth = HTTPBasicAuth(args.user, args.password)
-    Infrastructor.initialize_attempt_counter(conf, full_api_uri, auth)
+    # one record of what was sent per server
+    state_file = os.path.join(
+        cache_dir(), "attempts-" + hashlib.sha1(
+            full_api_uri.encode('utf-8')).hexdigest() + ".json") \
+        if args.incremental else None
+    if not Infrastructor.initialize_attempt_counter(
+            conf, full_api_uri, auth, args.gzip, args.batch_size,
+            args.retries, state_file):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
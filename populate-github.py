@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import time
+import sys
 
 import argparse
 from github import Github
@@ -7,7 +7,8 @@ from github import GithubException
 
 from Infrastructor import Infrastructor
 from config import Config
-from utils import self_check
+from github_api import DEFAULT_API_URL, ApiScheduler, GitHubClient
+from utils import normalize, report_failures, self_check
 
 
 class CannotAddUserToRepo(Exception):
@@ -25,6 +26,24 @@ def main() -> None:
     parser.add_argument('-v', '--verbose',
                         action='store_true',
                         help='enable verbose output')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of repositories set up concurrently '
+                             '(default: 4)')
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='list existing repositories and collaborators '
+                             'first and only create/invite what is missing')
+    parser.add_argument('-t', '--teams', choices=['group', 'student'],
+                        help='grant repositories to one team per group (or '
+                             'per student), kept across assignments, instead '
+                             'of inviting each student; implies --bulk')
+    parser.add_argument('--template', nargs='?', const='', metavar='NAME',
+                        help='build a template repository (by default '
+                             'COURSEASSIGNMENT-template) from the starter '
+                             'repo and generate missing repositories from it '
+                             'on GitHub instead of running push-starter.py; '
+                             'implies --bulk')
+    parser.add_argument('--api-url', type=str, default=DEFAULT_API_URL,
+                        help='GitHub API URL (default: %(default)s)')
 
     args = parser.parse_args()
 
@@ -33,52 +52,72 @@ def main() -> None:
     conf.pretty_print()
 
     # connect to github
-    g = Github(args.user, args.password)
-    org = g.get_organization("williams-cs")
+    g = Github(args.user, args.password, base_url=args.api_url)
+    scheduler = ApiScheduler(args.jobs, g)
+    org = scheduler.call(lambda: g.get_organization("williams-cs"))
 
-    for repo_name, group in conf.repo2group.items():
+    template = None
+    client = None
+    if args.template is not None:
+        name = args.template or (normalize(conf.course) +
+                                 normalize(conf.assignment_name) +
+                                 "-template")
+        if name in conf.repositories:
+            print(f"Template name {name} is also a student repository; "
+                  f"choose another with --template NAME.")
+            sys.exit(1)
+        client = GitHubClient(args.user, args.password, args.api_url,
+                              scheduler)
+        Infrastructor.build_template(conf, client, org.login, name)
+        template = f"{org.login}/{name}"
+
+    if args.bulk or args.teams or template:
+        summary = Infrastructor.provision_repositories(
+            conf, g, org, scheduler, args.teams, template, client)
+        if summary["failed"]:
+            sys.exit(1)
+        return
+
+    def populate(repo_name: str) -> None:
+        group = conf.repo2group[repo_name]
         # repo = None
         try:
             # check to see if repository already exists
-            repo = org.get_repo(repo_name)
+            repo = scheduler.call(lambda: org.get_repo(repo_name))
         except GithubException:
             # if not, create repository
             # auto_init=False so no README.md, license.txt, .gitignore ---
             # use push-starter.py after running this script
             print(f"creating repository {repo_name}")
-            repo = org.create_repo(repo_name,
-                                   description=(" and ".join(group) + "'s " +
-                                                conf.course + "repository for "
-                                                + conf.assignment_name + "."),
-                                   private=True,
-                                   auto_init=False
-                                   )
+            repo = scheduler.call(lambda: org.create_repo(
+                repo_name,
+                description=Infrastructor.repo_description(conf, group),
+                private=True,
+                auto_init=False
+            ))
 
         # add write privs for each student login
         for student in group:
             print(f"getting user for {student}")
-            suser = g.get_user(student)
+            suser = scheduler.call(lambda: g.get_user(student))
 
             # at this point, the repository is guaranteed to exist,
             # but sometimes Github will return a 404 for recently-created
-            # repositories
-            retries = 3
-            success = False
-            while retries > 0:
-                try:
-                    # add student as write-enabled collaborator
-                    print(f"adding {student} as collaborator to {repo_name} "
-                          f"repository.")
-                    repo.add_to_collaborators(suser)
-                    retries = 0
-                    success = True
-                except GithubException:
-                    retries -= 1
-                    print(f"Could not find repository {repo_name}. "
-                          f"Sleeping...")
-                    time.sleep(5)  # wait 5 seconds
-            if not success:
-                raise CannotAddUserToRepo
+            # repositories, so 404s are retried with backoff
+            try:
+                # add student as write-enabled collaborator
+                print(f"adding {student} as collaborator to {repo_name} "
+                      f"repository.")
+                scheduler.call(lambda: repo.add_to_collaborators(suser),
+                               retry_statuses=(404,))
+            except GithubException as e:
+                raise CannotAddUserToRepo(
+                    f"could not add {student} to {repo_name}") from e
+
+    _, failures = scheduler.map(populate, list(conf.repo2group.keys()))
+    report_failures(failures, "populate")
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
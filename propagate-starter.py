@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import sys
+
+import argparse
+
+from Infrastructor import Infrastructor
+from config import Config
+from github_api import DEFAULT_API_URL, ApiScheduler, GitHubClient
+from utils import self_check
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='apply a range of starter repo commits to every student '
+                    'repository on a new branch and open a pull request in '
+                    'each')
+    parser.add_argument("user", type=str,
+                        help="github username")
+    parser.add_argument("password", type=str,
+                        help="github password")
+    parser.add_argument('config', type=str,
+                        help='config file for the lab')
+    parser.add_argument('revisions', type=str,
+                        help='starter commits to apply, e.g., abc123..main '
+                             'or abc123^! for a single commit')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='enable verbose output')
+    parser.add_argument('-b', '--branch', type=str, default='starter-update',
+                        help='branch the commits are pushed to (default: '
+                             '%(default)s)')
+    parser.add_argument('-t', '--title', type=str,
+                        help='pull request title (default: subject of the '
+                             'last commit)')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='number of repositories processed '
+                             'concurrently (default: 8)')
+    parser.add_argument('--api-url', type=str, default=DEFAULT_API_URL,
+                        help='GitHub API URL (default: %(default)s)')
+
+    args = parser.parse_args()
+    self_check()
+    conf = Config(args.config, args.verbose)
+
+    client = GitHubClient(args.user, args.password, args.api_url,
+                          ApiScheduler(args.jobs))
+    if Infrastructor.propagate_starter(conf, args.revisions, args.branch,
+                                       client, args.jobs, args.title):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ from github import Github
 
 from Infrastructor import Infrastructor
 from config import Config
+from github_api import ApiScheduler
 from utils import self_check
 
 
@@ -28,13 +29,14 @@ def main() -> None:
 
     # init Github SDK
     g = Github(args.user, args.password)
+    scheduler = ApiScheduler(1, g)
     # guser = g.get_user()
-    org = g.get_organization("williams-cs")
+    org = scheduler.call(lambda: g.get_organization("williams-cs"))
 
     # TODO: verify that local repo is on the correct branch
 
     # issue pull request for given repo
-    Infrastructor.issue_pull_request(conf, args.repo, org)
+    Infrastructor.issue_pull_request(conf, args.repo, org, scheduler)
 
 
 if __name__ == "__main__":
@@ -13,11 +13,10 @@ def main() -> None:
     self_check()
     conf = Config(args.config, args.verbose)
 
-
-    # issue go through the student repos, and add them as remotes for the
-    # starter repo in the config. then push the default branch of the starter
-    # repo to the student repo's default branch
-    Infrastructor.push_starter(conf)
+    # push the default branch of the starter repo straight to each student
+    # repo's default branch
+    if Infrastructor.push_starter(conf, args.jobs):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
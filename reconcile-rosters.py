@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from utils import canonical_group_name
+
+
+class _Pairs(dict):
+    """A parsed JSON object that also remembers its key/value pairs in file
+    order, so that duplicate keys are not silently dropped"""
+
+    def __init__(self, pairs: List[Tuple[str, Any]]):
+        super().__init__(pairs)
+        self.pairs = pairs
+
+
+def read_roster(path: str) -> Set[str]:
+    """Reads an authoritative student list
+
+    :param path: A file with one student (or a comma-separated group) per line
+    :return: The casefolded student names
+    """
+    with open(path, "r") as fin:
+        return {name.strip().casefold()
+                for line in fin for name in line.split(",") if name.strip()}
+
+
+def student_file_entries(path: str) -> Iterator[Tuple[str, str]]:
+    """Streams the students of a `students.txt`-style group file
+
+    :param path: A file with one comma-separated group per line
+    :return: (student, group) pairs, casefolded
+    """
+    with open(path, "r") as fin:
+        for line in fin:
+            group = [name.strip().casefold()
+                     for name in line.split(",") if name.strip()]
+            gname = canonical_group_name(group)
+            for student in group:
+                yield student, gname
+
+
+def config_entries(path: str) -> Iterator[Tuple[str, str]]:
+    """Streams the `repository_map` of a config file, including entries that
+    a plain `json.load` would drop because their key is repeated
+
+    :param path: A config file
+    :return: (student, repository) pairs, students casefolded
+    """
+    with open(path, "r") as fin:
+        conf = json.load(fin, object_pairs_hook=_Pairs)
+    for student, repo in conf.get("repository_map", _Pairs([])).pairs:
+        yield student.casefold(), repo
+
+
+def reconcile(roster: Set[str], entries: Iterator[Tuple[str, str]]
+              ) -> Dict[str, List[str]]:
+    """Compares one student file or config against the roster in a single
+    pass
+
+    :param roster: The authoritative students
+    :param entries: (student, group or repository) pairs
+    :return: Sorted lists of "missing", "extra", "duplicate" (listed more than
+             once in the same group) and "multi_group" (listed in more than
+             one group) students
+    """
+    counts: Counter = Counter()
+    groups: Dict[str, Set[str]] = {}
+    for student, group in entries:
+        counts[student] += 1
+        groups.setdefault(student, set()).add(group)
+    return {
+        "missing": sorted(roster - counts.keys()),
+        "extra": sorted(counts.keys() - roster),
+        "duplicate": sorted(s for s, n in counts.items()
+                            if n > len(groups[s])),
+        "multi_group": sorted(s for s, g in groups.items() if len(g) > 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Compare any number of student files and config '
+                    'repository maps against an authoritative list; identify '
+                    'missing, extraneous, duplicate and multi-group students')
+    parser.add_argument('authoritative_list', type=str,
+                        help='file name for complete list of students')
+    parser.add_argument('-s', '--students', type=str, action='append',
+                        default=[], metavar='FILE',
+                        help='student file (one group per line); may be '
+                             'repeated')
+    parser.add_argument('-c', '--config', type=str, action='append',
+                        default=[], metavar='FILE',
+                        help='config file whose repository_map is checked; '
+                             'may be repeated')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    roster = read_roster(args.authoritative_list)
+    results: Dict[str, Dict[str, List[str]]] = {}
+    for path in args.students:
+        results[path] = reconcile(roster, student_file_entries(path))
+    for path in args.config:
+        results[path] = reconcile(roster, config_entries(path))
+
+    problems = any(any(r.values()) for r in results.values())
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for path, r in results.items():
+            if not any(r.values()):
+                print(f"{path}: OK")
+                continue
+            print(f"{path}:")
+            for kind, students in r.items():
+                if students:
+                    print(f"    {kind.replace('_', '-')} students: "
+                          f"{', '.join(students)}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
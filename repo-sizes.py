@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from config import Config
+from github_api import DEFAULT_API_URL, ApiScheduler, GitHubClient, \
+    repo_sizes
+from utils import self_check
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='list the size of every student repository on GitHub '
+                    'before cloning, flagging oversized repositories')
+    parser.add_argument("user", type=str,
+                        help="github username")
+    parser.add_argument("password", type=str,
+                        help="github password")
+    parser.add_argument('config', type=str,
+                        help='config file for the lab')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='enable verbose output')
+    parser.add_argument('-l', '--limit', type=float, default=50,
+                        help='flag repositories larger than this many MB '
+                             '(default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--api-url', type=str, default=DEFAULT_API_URL,
+                        help='GitHub API URL (default: %(default)s)')
+
+    args = parser.parse_args()
+    self_check()
+    conf = Config(args.config, args.verbose)
+
+    client = GitHubClient(args.user, args.password, args.api_url,
+                          ApiScheduler())
+    sizes = repo_sizes(client, conf.github_org, conf.repositories)
+    missing = [repo for repo in conf.repositories if repo not in sizes]
+    limit_kb = args.limit * 1024
+    oversized = sorted((repo for repo in sizes if sizes[repo] > limit_kb),
+                       key=lambda repo: -sizes[repo])
+
+    if args.json:
+        print(json.dumps({
+            "sizes_kb": sizes,
+            "oversized": oversized,
+            "missing": missing,
+        }, indent=2))
+        return
+
+    for repo in sorted(sizes, key=lambda repo: -sizes[repo]):
+        flag = "  OVERSIZED" if repo in oversized else ""
+        print(f"{sizes[repo] / 1024:10.1f} MB  {repo}{flag}")
+    for repo in missing:
+        print(f"{'?':>10}     {repo}  (not found in {conf.github_org})")
+    print(f"Total: {sum(sizes.values()) / 1024:.1f} MB in {len(sizes)} "
+          f"repositories; {len(oversized)} larger than {args.limit:g} MB.")
+    if oversized:
+        print("Consider setting clone_filter (e.g., \"blob:limit=1m\") or "
+              "sparse_paths in the config.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, List
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from config import Config  # noqa: E402
+
+try:
+    from requests.auth import HTTPBasicAuth
+    from Infrastructor import Infrastructor
+    HAVE_DEPENDENCIES = True
+except ImportError:
+    HAVE_DEPENDENCIES = False
+
+
+class AttemptHandler(BaseHTTPRequestHandler):
+    """Records the decoded JSON bodies; fails the first request if asked"""
+
+    def read_body(self) -> bytes:
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        data = b""
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            chunk = self.rfile.read(size + 2)[:size]
+            if size == 0:
+                return data
+            data += chunk
+
+    def do_POST(self) -> None:
+        server: Any = self.server
+        data = self.read_body()
+        if server.fail_first:
+            server.fail_first = False
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        server.encodings.append(self.headers.get("Content-Encoding"))
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        batch = json.loads(data.decode("utf-8"))
+        server.batches.append(batch)
+        reply = json.dumps({"added": len(batch)}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+@unittest.skipUnless(HAVE_DEPENDENCIES, "requires requests and PyGithub")
+class InitializeAttemptCounterTest(unittest.TestCase):
+    """Batches sent to a stand-in attempt server"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server: Any = HTTPServer(("127.0.0.1", 0), AttemptHandler)
+        self.server.batches = []
+        self.server.encodings = []
+        self.server.fail_first = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/admin/lab/add"
+        self.configs = [self.config(f"hw{i}") for i in range(5)]
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def config(self, assignment: str) -> Config:
+        path = os.path.join(self.tmp.name, f"{assignment}.json")
+        with open(path, "w") as f:
+            json.dump({
+                "hostname": "github", "course": "cs1",
+                "assignment_name": assignment,
+                "starter_repo": os.path.join(self.tmp.name, "starter"),
+                "github_org": "org", "feedback_branch": "TA-feedback",
+                "archive_path": os.path.join(self.tmp.name, "archive"),
+                "submission_path": os.path.join(self.tmp.name, "sub"),
+                "ta_path": os.path.join(self.tmp.name, "tas"),
+                "TAs": ["ta"], "rsync_excludes": [],
+                "repository_map": {"alice": f"cs1{assignment}-alice"},
+            }, f)
+        return Config(path, False, use_cache=False)
+
+    def upload(self, **kwargs: Any) -> bool:
+        with mock.patch("sys.stdout"):
+            return Infrastructor.initialize_attempt_counter(
+                self.configs, self.url, HTTPBasicAuth("user", "pass"),
+                batch_size=2, **kwargs)
+
+    def sent(self) -> List[Any]:
+        return [c for batch in self.server.batches for c in batch]
+
+    def test_uncompressed_by_default(self) -> None:
+        self.assertTrue(self.upload())
+        self.assertEqual([len(b) for b in self.server.batches], [2, 2, 1])
+        self.assertEqual(self.server.encodings, [None, None, None])
+        self.assertEqual(self.sent(), [c.jsondict for c in self.configs])
+
+    def test_gzip(self) -> None:
+        self.assertTrue(self.upload(compress=True))
+        self.assertEqual([len(b) for b in self.server.batches], [2, 2, 1])
+        self.assertEqual(self.server.encodings, ["gzip"] * 3)
+        self.assertEqual(self.sent(), [c.jsondict for c in self.configs])
+
+    def test_retry(self) -> None:
+        self.server.fail_first = True
+        with mock.patch("time.sleep"):
+            self.assertTrue(self.upload())
+        self.assertEqual([len(b) for b in self.server.batches], [2, 2, 1])
+        self.assertEqual(self.sent(), [c.jsondict for c in self.configs])
+
+
+if __name__ == "__main__":
+    unittest.main()
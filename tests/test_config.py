@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from config import Config  # noqa: E402
+
+
+class AssignTasTest(unittest.TestCase):
+    """`rendezvous` assignments with a saved `ta_weight`ed assignment"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repos = {f"s{i}": f"cs1hw1-s{i}" for i in range(12)}
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def config(self, tas: List[str]) -> Config:
+        path = os.path.join(self.tmp.name, "config.json")
+        with open(path, "w") as f:
+            json.dump({
+                "hostname": "github", "course": "cs1",
+                "assignment_name": "hw1",
+                "starter_repo": os.path.join(self.tmp.name, "starter"),
+                "github_org": "org", "feedback_branch": "TA-feedback",
+                "archive_path": os.path.join(self.tmp.name, "archive"),
+                "submission_path": os.path.join(self.tmp.name, "sub"),
+                "ta_path": os.path.join(self.tmp.name, "tas"),
+                "TAs": tas, "rsync_excludes": [],
+                "ta_assignment": "rendezvous", "ta_weight": "files",
+                "repository_map": self.repos,
+            }, f)
+        return Config(path, False, use_cache=False)
+
+    def save(self, conf: Config, assignments: Dict[str, str]) -> None:
+        os.makedirs(os.path.dirname(conf.ta_assignments_file))
+        with open(conf.ta_assignments_file, "w") as f:
+            json.dump(assignments, f)
+
+    def test_saved_assignment_is_kept(self) -> None:
+        conf = self.config(["ta1", "ta2", "ta3"])
+        saved = {repo: "ta1" for repo in self.repos.values()}
+        self.save(conf, saved)
+        conf.assign_tas()
+        self.assertEqual(conf.ta_assignments, saved)
+
+    def test_removed_ta(self) -> None:
+        conf = self.config(["ta1", "ta2", "ta3"])
+        repos = sorted(self.repos.values())
+        saved = {repo: ["ta1", "ta2", "ta3"][i % 3]
+                 for i, repo in enumerate(repos)}
+        self.save(conf, saved)
+
+        conf = self.config(["ta1", "ta2"])
+        conf.assign_tas()
+        unweighted = self.config(["ta1", "ta2"])
+        unweighted.ta_weight = "none"
+        unweighted.assign_tas()
+        for repo in repos:
+            if saved[repo] == "ta3":
+                # reassigned as if there were no saved assignment
+                self.assertEqual(conf.ta_assignments[repo],
+                                 unweighted.ta_assignments[repo])
+            else:
+                self.assertEqual(conf.ta_assignments[repo], saved[repo])
+        self.assertNotIn("ta3", conf.ta_assignments.values())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gitbackend import BACKENDS  # noqa: E402
+
+try:
+    import dulwich  # noqa: F401
+    HAVE_DULWICH = True
+except ImportError:
+    HAVE_DULWICH = False
+
+
+def git(rdir: str, *args: str) -> str:
+    return subprocess.run(["git"] + list(args), cwd=rdir, check=True,
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+
+def write(rdir: str, path: str, text: str) -> None:
+    full = os.path.join(rdir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "w") as f:
+        f.write(text)
+
+
+@unittest.skipUnless(HAVE_DULWICH, "requires dulwich")
+class CommitAllTest(unittest.TestCase):
+    """Both backends must commit the same tree for the same change set"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.tmp.name, "origin")
+        os.makedirs(self.origin)
+        git(self.origin, "init", "--quiet")
+        self.configure(self.origin)
+        write(self.origin, ".gitignore", "*.class\n")
+        write(self.origin, "README.md", "starter\n")
+        write(self.origin, "sub/a.txt", "a\n")
+        write(self.origin, "sub/b.txt", "b\n")
+        write(self.origin, "sub/c.txt", "c\n")
+        write(self.origin, "run.sh", "#!/bin/sh\n")
+        os.chmod(os.path.join(self.origin, "run.sh"), 0o755)
+        git(self.origin, "add", "-A")
+        git(self.origin, "commit", "--quiet", "-m", "starter")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    @staticmethod
+    def configure(rdir: str) -> None:
+        git(rdir, "config", "user.name", "TA")
+        git(rdir, "config", "user.email", "ta@example.com")
+
+    def commit_with(self, name: str) -> str:
+        rdir = os.path.join(self.tmp.name, name)
+        git(self.tmp.name, "clone", "--quiet", self.origin, rdir)
+        self.configure(rdir)
+
+        # modified, deleted, added (also nested), ignored, and mode-only
+        write(rdir, "README.md", "feedback\n")
+        os.remove(os.path.join(rdir, "sub/b.txt"))
+        write(rdir, "FEEDBACK.md", "Score: 10\n")
+        write(rdir, "notes/ta.txt", "notes\n")
+        write(rdir, "Main.class", "binary\n")
+        os.chmod(os.path.join(rdir, "sub/c.txt"), 0o755)
+        os.chmod(os.path.join(rdir, "run.sh"), 0o644)
+
+        out: List[str] = []
+        self.assertTrue(BACKENDS[name]().commit_all(rdir, "Feedback", out))
+        self.assertEqual(git(rdir, "status", "--porcelain"), "")
+        return git(rdir, "ls-tree", "-r", "HEAD")
+
+    def test_same_tree(self) -> None:
+        subprocess_tree = self.commit_with("subprocess")
+        modes = {line.split("\t")[1]: line.split()[0]
+                 for line in subprocess_tree.splitlines()}
+        self.assertEqual(modes["sub/c.txt"], "100755")
+        self.assertEqual(modes["run.sh"], "100644")
+        self.assertEqual(self.commit_with("dulwich"), subprocess_tree)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+from typing import Any, Dict, List
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    from github_api import GitHubAPIError, org_membership
+    HAVE_DEPENDENCIES = True
+except ImportError:
+    HAVE_DEPENDENCIES = False
+
+
+@unittest.skipUnless(HAVE_DEPENDENCIES, "requires requests")
+class OrgMembershipTest(unittest.TestCase):
+    """Roster lookups with and without access to invitations"""
+
+    def client(self, invitations_status: int) -> Any:
+        def get_all(path: str) -> List[Dict[str, Any]]:
+            if path.endswith("/members"):
+                return [{"login": "Alice"}, {"login": "bob"}]
+            if invitations_status != 200:
+                raise GitHubAPIError(f"GET {path} failed",
+                                     invitations_status)
+            return [{"login": "Carol"}, {"login": None, "email": "d@x"}]
+        return mock.Mock(get_all=get_all)
+
+    def test_invitations(self) -> None:
+        membership = org_membership(self.client(200), "org")
+        self.assertEqual(membership.members, {"alice", "bob"})
+        self.assertEqual(membership.invited, {"carol"})
+
+    def test_invitations_forbidden(self) -> None:
+        for status in (403, 404):
+            with mock.patch("sys.stderr") as stderr:
+                membership = org_membership(self.client(status), "org")
+            self.assertEqual(membership.members, {"alice", "bob"})
+            self.assertEqual(membership.invited, set())
+            self.assertTrue(stderr.write.called)
+
+    def test_other_errors(self) -> None:
+        with self.assertRaises(GitHubAPIError):
+            org_membership(self.client(500), "org")
+
+
+if __name__ == "__main__":
+    unittest.main()
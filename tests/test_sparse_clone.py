@@ -0,0 +1,131 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import List
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from config import Config  # noqa: E402
+from gitbackend import BACKENDS  # noqa: E402
+
+try:
+    from Infrastructor import Infrastructor
+    HAVE_DEPENDENCIES = True
+except ImportError:
+    HAVE_DEPENDENCIES = False
+
+try:
+    import dulwich.repo
+    HAVE_DULWICH = True
+except ImportError:
+    HAVE_DULWICH = False
+
+
+def git(rdir: str, *args: str) -> str:
+    return subprocess.run(["git"] + list(args), cwd=rdir, check=True,
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+
+def write(rdir: str, path: str, text: str) -> None:
+    full = os.path.join(rdir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "w") as f:
+        f.write(text)
+
+
+@unittest.skipUnless(HAVE_DEPENDENCIES, "requires requests and PyGithub")
+class SparseCloneTest(unittest.TestCase):
+    """Submission clones with `sparse_paths` and the git backends"""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.tmp.name, "origin")
+        os.makedirs(self.origin)
+        git(self.origin, "init", "--quiet", "--initial-branch", "main")
+        git(self.origin, "config", "user.name", "Student")
+        git(self.origin, "config", "user.email", "student@example.com")
+        write(self.origin, "README.md", "starter\n")
+        write(self.origin, "src/A.java", "class A {}\n")
+        write(self.origin, "data/big.csv", "1,2,3\n")
+        git(self.origin, "add", "-A")
+        git(self.origin, "commit", "--quiet", "-m", "submission")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def config(self, backend: str) -> Config:
+        path = os.path.join(self.tmp.name, f"{backend}.json")
+        with open(path, "w") as f:
+            json.dump({
+                "hostname": "github", "course": "cs1",
+                "assignment_name": "hw1", "starter_repo": self.origin,
+                "github_org": "org", "feedback_branch": "TA-feedback",
+                "archive_path": os.path.join(self.tmp.name, "archive"),
+                "submission_path": os.path.join(self.tmp.name, "sub"),
+                "ta_path": os.path.join(self.tmp.name, "tas"),
+                "TAs": ["ta"], "rsync_excludes": [],
+                "git_backend": backend, "sparse_paths": ["src"],
+                "repository_map": {"alice": "cs1hw1-alice"},
+            }, f)
+        return Config(path, False, use_cache=False)
+
+    def sparse_clone(self, conf: Config, name: str) -> str:
+        rpath = os.path.join(self.tmp.name, name)
+        with mock.patch.object(Config, "repo_ssh_path",
+                               lambda self, repo: self.starter_repo):
+            Infrastructor.pull_repo(conf, "cs1hw1-alice", rpath, [],
+                                    partial=True)
+        git(rpath, "config", "user.name", "TA")
+        git(rpath, "config", "user.email", "ta@example.com")
+        return rpath
+
+    def backend_results(self, name: str, rpath: str) -> List[object]:
+        backend = BACKENDS[name]()
+        head = git(rpath, "rev-parse", "HEAD").strip()
+        results: List[object] = [
+            backend.branch_exists(rpath, "main"),
+            backend.rev_before(rpath, "main", 2 ** 31 - 1) == head,
+            backend.read_blob(rpath, "main", "data/big.csv"),
+        ]
+        out: List[str] = []
+        backend.create_branch(rpath, "TA-feedback", out)
+        write(rpath, "src/FEEDBACK.md", "Score: 10\n")
+        results.append(backend.commit_all(rpath, "Feedback", out))
+        results.append(git(rpath, "ls-tree", "-r", "--name-only", "HEAD"))
+        return results
+
+    def test_subprocess_backend(self) -> None:
+        rpath = self.sparse_clone(self.config("subprocess"), "subprocess")
+        self.assertEqual(sorted(os.listdir(rpath)),
+                         [".git", "README.md", "src"])
+        self.assertEqual(self.backend_results("subprocess", rpath), [
+            True, True, b"1,2,3\n", True,
+            "README.md\ndata/big.csv\nsrc/A.java\nsrc/FEEDBACK.md\n"])
+
+    @unittest.skipUnless(HAVE_DULWICH, "requires dulwich")
+    def test_dulwich_backend(self) -> None:
+        with self.assertRaises(SystemExit):
+            self.config("dulwich")
+
+        # why: dulwich either cannot open a sparse clone at all (e.g.,
+        # 0.21.7 and the worktreeConfig extension) or does not honor the
+        # sparse checkout and commits the files outside it as deleted
+        conf = self.config("subprocess")
+        expected = self.backend_results(
+            "subprocess", self.sparse_clone(conf, "subprocess"))
+        rpath = self.sparse_clone(conf, "dulwich")
+        try:
+            results = self.backend_results("dulwich", rpath)
+        except dulwich.repo.UnsupportedExtension:
+            return
+        self.assertEqual(results[:4], expected[:4])
+        self.assertNotIn("data/big.csv", str(results[4]))
+        self.assertIn("data/big.csv", str(expected[4]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,18 @@
+import hashlib
 import re
+import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from distutils import spawn
 
-from typing import Sequence, Dict
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, \
+    TypeVar
+
+# Generics for type hints in run_per_repo()
+_T = TypeVar("_T")
+
+SYNC_STATE_DIR = ".infrastructor"
+"Name of the bookkeeping directory kept under archive and submission paths"
 
 
 def normalize(name: str) -> str:
@@ -56,3 +66,134 @@ def round_robin_map(tas: Sequence[str], repos: Sequence[str]) -> Dict[str, str]:
             i = 0
 
     return d
+
+
+def _rendezvous_score(*keys: str) -> int:
+    digest = hashlib.sha1("/".join(keys).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def rendezvous_map(tas: Sequence[str], repos: Sequence[str],
+                   weights: Optional[Mapping[str, float]] = None,
+                   slack: float = 0.1) -> Dict[str, str]:
+    """Assigns repositories to TAs by rendezvous (highest random weight)
+    hashing with bounded loads
+
+    Every repository ranks the TAs by a hash of (TA, repository) and goes to
+    the first TA in its ranking whose load stays within `1 + slack` times
+    the average.  Adding or removing a repository or a TA therefore only
+    moves the repositories that ranked it first, plus the few that overflow.
+
+    :param tas: Names of the TAs
+    :param repos: Names of the repositories
+    :param weights: Optional workload of each repository (default 1)
+    :param slack: How far above the average load a TA may go
+    :return: A map from repository to TA
+    """
+    weights = weights or {}
+    total = sum(weights.get(r, 1) for r in repos)
+    capacity = (1 + slack) * total / len(tas)
+    load = {ta: 0.0 for ta in tas}
+    d: Dict[str, str] = {}
+
+    # a fixed order (by hash, not by name) keeps overflows local
+    for r in sorted(repos, key=lambda r: _rendezvous_score(r)):
+        w = weights.get(r, 1)
+        ranked = sorted(tas, key=lambda ta: _rendezvous_score(ta, r),
+                        reverse=True)
+        # a repository too big for anyone goes to the least loaded TA
+        ta = next((ta for ta in ranked if load[ta] + w <= capacity),
+                  min(ranked, key=lambda ta: load[ta]))
+        d[r] = ta
+        load[ta] += w
+
+    return {r: d[r] for r in sorted(d)}
+
+
+class CommandFailed(Exception):
+    """Raised when an external command exits with a non-zero status"""
+
+    def __init__(self, cmd: Sequence[str], returncode: int):
+        super().__init__(f"'{' '.join(cmd)}' exited with status {returncode}")
+        self.cmd = cmd
+        self.returncode = returncode
+
+
+def run_logged(cmd: Sequence[str], out: List[str], cwd: Optional[str] = None,
+               check: bool = True) -> subprocess.CompletedProcess:
+    """Runs a command, appending its combined stdout/stderr to `out`
+
+    :param cmd: The command and its arguments
+    :param out: Output buffer for the repository being processed
+    :param cwd: Working directory for the command
+    :param check: Whether to raise CommandFailed on a non-zero exit status
+    :return: The completed process; `stdout` holds the captured output
+    """
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    out.append(proc.stdout)
+    if check and proc.returncode != 0:
+        raise CommandFailed(cmd, proc.returncode)
+    return proc
+
+
+def run_per_repo(fn: Callable[[str, List[str]], _T], repos: Sequence[str],
+                 jobs: int = 1) -> Tuple[Dict[str, _T], Dict[str, Exception]]:
+    """Runs `fn(repo, out)` for every repository using up to `jobs` threads
+
+    Each call gets its own output buffer `out`, which is printed in one piece
+    when that repository finishes so that output from concurrent repositories
+    never interleaves.  An exception raised for one repository is recorded
+    and does not stop the others.
+
+    :param fn: The per-repository pipeline
+    :param repos: The repositories to process
+    :param jobs: Maximum number of repositories processed at the same time
+    :return: A pair of (results, failures), both keyed by repository and
+             listed in the order of `repos`
+    """
+    buffers: Dict[str, List[str]] = {repo: [] for repo in repos}
+    results: Dict[str, _T] = {}
+    failures: Dict[str, Exception] = {}
+
+    def finish(repo: str) -> None:
+        text = "".join(buffers[repo])
+        if text:
+            print(text, end="" if text.endswith("\n") else "\n", flush=True)
+
+    if jobs <= 1:
+        for repo in repos:
+            try:
+                results[repo] = fn(repo, buffers[repo])
+            except Exception as e:
+                failures[repo] = e
+            finish(repo)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(fn, repo, buffers[repo]): repo
+                       for repo in repos}
+            for future in as_completed(futures):
+                repo = futures[future]
+                try:
+                    results[repo] = future.result()
+                except Exception as e:
+                    failures[repo] = e
+                finish(repo)
+
+    # restore repository order
+    return ({r: results[r] for r in repos if r in results},
+            {r: failures[r] for r in repos if r in failures})
+
+
+def report_failures(failures: Mapping[str, Exception], what: str) -> None:
+    """Prints a summary of per-repository failures to stderr
+
+    :param failures: Map from repository to the exception it raised
+    :param what: Short description of the operation, e.g., "pull"
+    """
+    if not failures:
+        return
+    print(f"ERROR: {what} failed for {len(failures)} repositories:",
+          file=sys.stderr)
+    for repo, e in failures.items():
+        print(f"  {repo}: {e}", file=sys.stderr)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 
-from github import Github
+from github_api import DEFAULT_API_URL, ApiScheduler, GitHubClient, \
+    org_membership, resolve_users
 
 
 def main() -> None:
@@ -16,35 +18,57 @@ def main() -> None:
                         help='org name')
     parser.add_argument('sfile', type=str,
                         help='student file')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of concurrent GitHub requests '
+                             '(default: 4)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--api-url', type=str, default=DEFAULT_API_URL,
+                        help='GitHub API URL (default: %(default)s)')
     args = parser.parse_args()
 
-    # init Github SDK
-    g = Github(args.user, args.password)
+    client = GitHubClient(args.user, args.password, args.api_url,
+                          ApiScheduler(args.jobs))
 
     with open(args.sfile, 'r') as fin:
-        students = [line.strip() for line in fin]
+        students = [line.strip() for line in fin if line.strip()]
 
-    non_github = []
-    for student in students:
-        try:
-            s = g.get_user(student)
-        except Exception:
-            # print(f"{student} not a github member.")
-            non_github.append(student)
-
-    org = g.get_organization("williams-cs")
-    members = org.get_members()
-    logins = {member.login for member in members}
-    non_org = []
+    # one batched lookup for all accounts, one listing of the org
+    accounts = resolve_users(client, students)
+    membership = org_membership(client, args.orgname)
+
+    roster = {}
     for student in students:
-        if student not in members:
-            # print(f"{student} not a member of {orgname}.")
-            non_org.append(student)
+        login = accounts[student]
+        roster[student] = {
+            "login": login,
+            "member": login is not None and
+            login.lower() in membership.members,
+            "invited": login is not None and
+            login.lower() in membership.invited,
+        }
+    non_github = [s for s in students if roster[s]["login"] is None]
+    invited = [s for s in students if roster[s]["invited"]]
+    non_org = [s for s in students
+               if roster[s]["login"] is not None
+               and not roster[s]["member"] and not roster[s]["invited"]]
+
+    if args.json:
+        print(json.dumps({
+            "org": args.orgname,
+            "not_in_github": non_github,
+            "not_in_org": non_org,
+            "invited": invited,
+            "students": roster,
+        }, indent=2))
+        return
 
     print("Not in github:")
     print(non_github)
     print(f"Not in {args.orgname}:")
     print(non_org)
+    print(f"Invited to {args.orgname}, but not yet accepted:")
+    print(invited)
 
 
 if __name__ == "__main__":